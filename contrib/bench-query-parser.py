@@ -0,0 +1,48 @@
+#!/bin/python
+# coding: utf-8
+
+# Benchmark of the precompiled whois query parser against the argparse
+# parser, which SimpleWhoisServer used to build for every request.
+
+import argparse
+import timeit
+
+import lglass.whois.engine
+import lglass.whois.server
+
+requests = [
+    "AS4242420000",
+    "-r 172.20.0.0/14",
+    "-rx -Tinetnum,inet6num 172.22.0.0/24",
+    "-k -M -s DN42 fd00::/8",
+    "-i mnt-by FOO-MNT",
+    "--types=person --no-related FOO-DN42",
+    "-q sources",
+]
+
+argparser = argparse.ArgumentParser()
+argparser.add_argument("--number", "-n", type=int, default=10000)
+args = argparser.parse_args()
+
+server = lglass.whois.server.SimpleWhoisServer(
+    lglass.whois.engine.WhoisEngine(), [None], default_sources=[])
+parser = lglass.whois.server.QueryParser(server._build_argparser())
+
+for request in requests:
+    expected = server._build_argparser().parse_args(request.split())
+    got = parser.parse(request)
+    if lglass.whois.engine.args_to_query_kwargs(expected) != \
+            lglass.whois.engine.args_to_query_kwargs(got):
+        print("Mismatch for {!r}: {} != {}".format(request, expected, got))
+
+
+def bench(name, func):
+    t = timeit.timeit(lambda: [func(r) for r in requests], number=args.number)
+    print("{:<24} {:10.2f} us/request".format(
+        name, t / args.number / len(requests) * 1e6))
+
+
+bench("argparse (per request)",
+      lambda r: server._build_argparser().parse_args(r.split()))
+bench("QueryParser (uncached)", parser._parse)
+bench("QueryParser (cached)", parser.parse)
@@ -0,0 +1,21 @@
+#!/bin/python
+# coding: utf-8
+
+# This script converts a file database in place to another shard depth. Stop
+# all writers before running it; an interrupted run can simply be repeated.
+
+import argparse
+
+import lglass.nic
+
+argparser = argparse.ArgumentParser(
+        description="Convert file database to a sharded directory layout")
+argparser.add_argument("--depth", "-d", type=int, default=2,
+        help="number of shard directory levels, 0 for a flat layout")
+argparser.add_argument("database")
+args = argparser.parse_args()
+
+db = lglass.nic.FileDatabase(args.database)
+print("Converting from shard depth {} to {}".format(db.shard_depth,
+    args.depth))
+db.reshard(args.depth)
@@ -10,10 +10,45 @@ import lglass.dn42
 
 db_cls = lglass_sql.nic.NicDatabase
 
+def sync_journal(src, dst, since, dn42=False, delete=False,
+        filter_source=None):
+    serial = since
+    for serial, operation, obj in src.changes(since):
+        if filter_source and obj.source != filter_source:
+            continue
+        objs = lglass.dn42.fix_object(obj) if dn42 else [obj]
+        for obj in objs:
+            if operation == 'ADD':
+                yield ('ADD', obj.object_class, obj.primary_key)
+                dst.save(obj)
+            elif operation == 'DEL' and delete and obj in dst:
+                yield ('DEL', obj.object_class, obj.primary_key)
+                dst.delete(obj)
+    dst.manifest["sync-serial"] = serial
+
 def sync(src, dst, dn42=False, delete=False, initial=False, filter_source=None):
     last_update = dst.manifest.last_modified_datetime
 
-    for obj in src.find():
+    # Replay the journal of the source database, if the destination knows the
+    # serial it was synchronized to and the journal still has all changes
+    # since then. Otherwise, fall back to a full synchronization.
+    if not initial and getattr(src, "journal", None) is not None and \
+            "sync-serial" in dst.manifest and \
+            src.journal.complete_since(int(dst.manifest["sync-serial"])):
+        yield from sync_journal(src, dst, int(dst.manifest["sync-serial"]),
+                dn42=dn42, delete=delete, filter_source=filter_source)
+        dst.manifest.remove("last-modified")
+        dst.manifest.last_modified = datetime.datetime.now()
+        dst.save_manifest()
+        return
+    if getattr(src, "journal", None) is not None:
+        dst.manifest["sync-serial"] = src.journal.last_serial
+
+    if hasattr(src, "find_parallel"):
+        objects = src.find_parallel(ordered=False)
+    else:
+        objects = src.find()
+    for obj in objects:
         if filter_source and obj.source != filter_source:
             continue
         if obj.last_modified_datetime > last_update or initial:
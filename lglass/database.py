@@ -1,11 +1,37 @@
+import contextlib
+import contextvars
 from abc import ABC, abstractmethod
 
+import lglass.iostats
 import lglass.object
 
 object_classes = {}
 class_synonyms = []
 primary_key_rules = {}
 
+_checkpoint = contextvars.ContextVar("lglass_database_checkpoint",
+                                     default=None)
+
+
+def checkpoint():
+    """Call the checkpoint function of the current scope, if there is one.
+    Scans call it for every object, hence the function can abort a scan by
+    raising an exception."""
+    function = _checkpoint.get()
+    if function is not None:
+        function()
+
+
+@contextlib.contextmanager
+def checkpoint_scope(function):
+    """Context manager which makes `function` the checkpoint function of the
+    current scope."""
+    token = _checkpoint.set(function)
+    try:
+        yield function
+    finally:
+        _checkpoint.reset(token)
+
 
 def primary_class(object_class, class_synonyms=class_synonyms,
                   object_classes=object_classes):
@@ -101,8 +127,11 @@ class Database(ABC):
     def find(self, filter=None, classes=None, keys=None):
         """Perform a lookup similarly to lookup, but fetches the objects and
         applies a (optional) filter on the resulting generator."""
+        lglass.iostats.count("find")
         for object_class, object_key in self.lookup(classes=classes, keys=keys):
+            checkpoint()
             try:
+                lglass.iostats.count("find_fetch")
                 obj = self.fetch(object_class, object_key)
             except:
                 continue
@@ -207,4 +236,4 @@ class ProxyDatabase(Database):
     def database_name(self):
         return self.backend.database_name
 
-__all__ = ('Database', 'ProxyDatabase')
+__all__ = ('Database', 'ProxyDatabase', 'checkpoint', 'checkpoint_scope')
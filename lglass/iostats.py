@@ -0,0 +1,43 @@
+# coding: utf-8
+
+import collections
+import contextlib
+import contextvars
+
+_counters = contextvars.ContextVar("lglass_iostats", default=None)
+
+
+def count(name, n=1):
+    """Add `n` to the counter `name` of the current scope, if there is
+    one."""
+    counters = _counters.get()
+    if counters is not None:
+        counters[name] += n
+
+
+def current():
+    """Return the counters of the current scope, or None."""
+    return _counters.get()
+
+
+@contextlib.contextmanager
+def scope(counters=None):
+    """Context manager which makes `counters`, or a new Counter, the current
+    scope of I/O counters. Scopes are inherited by asyncio tasks, but not by
+    threads, which need to enter a scope with the same counters on their
+    own."""
+    if counters is None:
+        counters = collections.Counter()
+    token = _counters.set(counters)
+    try:
+        yield counters
+    finally:
+        _counters.reset(token)
+
+
+def format_counters(counters):
+    return " ".join("{}={}".format(name, n)
+                    for name, n in sorted(counters.items()))
+
+
+__all__ = ("count", "current", "scope", "format_counters")
@@ -0,0 +1,232 @@
+# coding: utf-8
+
+import fcntl
+import json
+import os
+import threading
+import time
+
+
+class Journal(object):
+    """Append-only log of database changes. Every entry has a serial number,
+    an operation ('ADD' or 'DEL'), a timestamp, the primary class and key of
+    the object and the object itself.
+
+    The journal is stored in a directory as a sequence of segment files,
+    which are named by the first serial they contain. A new segment is
+    started when the current one holds `segment_size` entries. Writers in
+    different processes are serialized by a lock file."""
+
+    def __init__(self, path, segment_size=10000, first_serial=1):
+        self.path = path
+        self.segment_size = segment_size
+        self._first_serial = first_serial
+        self._lock = threading.Lock()
+        self._segment = None
+        self._segment_entries = 0
+        self._segment_size = 0
+        self._mtime = None
+        self._last_serial = first_serial - 1
+        os.makedirs(path, exist_ok=True)
+        self._load()
+
+    def __repr__(self):
+        return "Journal({!r})".format(self.path)
+
+    def segments(self):
+        """Return sorted list of tuples of first serial and path of all
+        segment files."""
+        segments = []
+        for name in os.listdir(self.path):
+            if not name.endswith(".journal"):
+                continue
+            try:
+                segments.append((int(name[:-8]),
+                                 os.path.join(self.path, name)))
+            except ValueError:
+                continue
+        return sorted(segments)
+
+    def _load(self):
+        self._mtime = os.stat(self.path).st_mtime_ns
+        segments = self.segments()
+        if not segments:
+            self._segment = None
+            self._segment_entries = 0
+            self._segment_size = 0
+            return
+        _, self._segment = segments[-1]
+        self._segment_entries = 0
+        for entry in _read_segment(self._segment):
+            self._segment_entries += 1
+            self._last_serial = entry["serial"]
+        self._segment_size = os.stat(self._segment).st_size
+        if not self._segment_entries and len(segments) > 1:
+            for entry in _read_segment(segments[-2][1]):
+                self._last_serial = entry["serial"]
+
+    def _changed(self):
+        try:
+            return os.stat(self.path).st_mtime_ns != self._mtime or \
+                self._segment is None or \
+                os.stat(self._segment).st_size != self._segment_size
+        except FileNotFoundError:
+            return True
+
+    def refresh(self):
+        """Reload the state of the journal if it was modified by another
+        process."""
+        with self._lock:
+            if self._changed():
+                self._load()
+
+    @property
+    def last_serial(self):
+        """Serial of the most recent entry, or the serial preceding the
+        first serial for an empty journal."""
+        return self._last_serial
+
+    @property
+    def first_serial(self):
+        """Serial of the oldest entry which is still available."""
+        for first, path in self.segments():
+            for entry in _read_segment(path):
+                return entry["serial"]
+        return self._last_serial + 1
+
+    @property
+    def compacted_serial(self):
+        """Serial up to which the journal was compacted, or 0."""
+        try:
+            with open(os.path.join(self.path, "COMPACTED")) as fh:
+                return int(fh.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def complete_since(self, since):
+        """Return True if the journal still contains every change after the
+        serial `since`, i.e. if a consumer at `since` can catch up by
+        replaying it. Consumers behind a truncated or compacted part of the
+        journal have to resynchronize completely."""
+        return since >= self.first_serial - 1 and \
+            since >= self.compacted_serial
+
+    def append(self, operation, object_class, object_key, obj):
+        """Append a single change and return its serial."""
+        return self.extend([(operation, object_class, object_key, obj)])
+
+    def extend(self, changes, fsync=False):
+        """Append an iterable of tuples of operation, primary class, primary
+        key and object, and return the serial of the last entry."""
+        changes = list(changes)
+        if not changes:
+            return self._last_serial
+        with self._lock, open(os.path.join(self.path, "LOCK"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # Pick up entries written by other processes
+            if self._changed():
+                self._load()
+            lines = []
+            serial = self._last_serial
+            now = time.time()
+            for operation, object_class, object_key, obj in changes:
+                serial += 1
+                if self._segment is None or \
+                        self._segment_entries >= self.segment_size:
+                    self._write(lines, fsync)
+                    lines = []
+                    self._segment = os.path.join(
+                        self.path, "{:020d}.journal".format(serial))
+                    self._segment_entries = 0
+                    self._segment_size = 0
+                    self._mtime = None
+                lines.append(json.dumps({
+                    "serial": serial,
+                    "operation": operation,
+                    "time": now,
+                    "class": object_class,
+                    "key": object_key,
+                    "object": obj.to_json()}) + "\n")
+                self._segment_entries += 1
+                self._last_serial = serial
+            self._write(lines, fsync)
+        return serial
+
+    def _write(self, lines, fsync):
+        if not lines:
+            return
+        data = "".join(lines).encode()
+        with open(self._segment, "ab") as fh:
+            fh.write(data)
+            fh.flush()
+            if fsync:
+                os.fsync(fh.fileno())
+        self._segment_size += len(data)
+
+    def changes(self, since=0):
+        """Generator that yields all entries with a serial greater than
+        `since` as dictionaries, in serial order."""
+        segments = self.segments()
+        for i, (first, path) in enumerate(segments):
+            if i + 1 < len(segments) and segments[i + 1][0] <= since + 1:
+                continue
+            for entry in _read_segment(path):
+                if entry["serial"] > since:
+                    yield entry
+
+    def truncate(self, before):
+        """Remove all segments which only contain entries with serials lower
+        than `before`. Consumers which are behind have to resynchronize
+        completely."""
+        segments = self.segments()
+        with self._lock:
+            for (_, path), (next_first, _) in zip(segments, segments[1:]):
+                if next_first <= before:
+                    os.unlink(path)
+
+    def compact(self):
+        """Rewrite all segments except for the current one, keeping only the
+        most recent entry for every object. Serials are preserved, so
+        consumers see gaps, but replaying the journal still results in the
+        same database. Consumers within the compacted segments may miss
+        intermediate changes, see complete_since."""
+        segments = self.segments()
+        if len(segments) < 2:
+            return
+        latest = {}
+        for _, path in segments:
+            for entry in _read_segment(path):
+                latest[(entry["class"], entry["key"])] = entry["serial"]
+        with self._lock:
+            for _, path in segments[:-1]:
+                entries = [entry for entry in _read_segment(path)
+                           if latest[(entry["class"], entry["key"])] ==
+                           entry["serial"]]
+                tmp_path = path + ".tmp"
+                with open(tmp_path, "w") as fh:
+                    for entry in entries:
+                        fh.write(json.dumps(entry) + "\n")
+                if entries:
+                    os.rename(tmp_path, path)
+                else:
+                    os.unlink(tmp_path)
+                    os.unlink(path)
+            tmp_path = os.path.join(self.path, "COMPACTED.tmp")
+            with open(tmp_path, "w") as fh:
+                fh.write("{}\n".format(segments[-1][0] - 1))
+            os.rename(tmp_path, os.path.join(self.path, "COMPACTED"))
+
+
+def _read_segment(path):
+    try:
+        with open(path) as fh:
+            for line in fh:
+                # Skip lines which are still being written
+                if not line.endswith("\n"):
+                    break
+                yield json.loads(line)
+    except FileNotFoundError:
+        pass
+
+
+__all__ = ("Journal",)
@@ -0,0 +1,412 @@
+# coding: utf-8
+
+import hashlib
+import json
+import socket
+import socketserver
+import threading
+import time
+
+
+def object_digest(obj, ignore_keys=("last-modified",)):
+    """Compute the hex digest of an object, ignoring the given keys, which
+    usually differ between replicas."""
+    h = hashlib.sha256()
+    for key, value in obj.items():
+        if key in ignore_keys:
+            continue
+        h.update("{}: {}\n".format(key, value).encode())
+    return h.hexdigest()
+
+
+def _combine(digests):
+    h = hashlib.sha256()
+    for name, digest in sorted(digests.items()):
+        h.update("{} {}\n".format(name, digest).encode())
+    return h.hexdigest()
+
+
+class MerkleTree(object):
+    """Tree of object digests with three levels: object classes, key-prefix
+    buckets within a class and the objects within a bucket. Every inner node
+    carries the digest of its children, hence two trees can be compared top
+    down, descending only into subtrees with different digests.
+
+    The tree is maintained incrementally by `update` and `remove`, or by
+    `apply_changes` for the changes of a database journal. Digests of inner
+    nodes are recomputed lazily for modified buckets only."""
+
+    def __init__(self, bucket_length=2, ignore_keys=("last-modified",)):
+        self.bucket_length = bucket_length
+        self.ignore_keys = tuple(ignore_keys)
+        self.serial = None
+        self._leaves = {}
+        self._buckets = {}
+        self._classes = {}
+        self._root = None
+
+    def __repr__(self):
+        return "<MerkleTree {}>".format(self.root())
+
+    def bucket(self, object_key):
+        """Return the bucket of an object key."""
+        return hashlib.sha1(
+            object_key.lower().encode()).hexdigest()[:self.bucket_length]
+
+    def update(self, object_class, object_key, digest):
+        """Set the digest of an object."""
+        bucket = self.bucket(object_key)
+        self._leaves.setdefault(object_class, {}).setdefault(
+            bucket, {})[object_key] = digest
+        self._invalidate(object_class, bucket)
+
+    def remove(self, object_class, object_key):
+        """Remove an object from the tree."""
+        bucket = self.bucket(object_key)
+        try:
+            del self._leaves[object_class][bucket][object_key]
+        except KeyError:
+            return
+        if not self._leaves[object_class][bucket]:
+            del self._leaves[object_class][bucket]
+        if not self._leaves[object_class]:
+            del self._leaves[object_class]
+        self._invalidate(object_class, bucket)
+
+    def add_object(self, database, obj):
+        object_class, object_key = database.primary_spec(obj)
+        self.update(object_class, object_key,
+                    object_digest(obj, self.ignore_keys))
+
+    def remove_object(self, database, obj):
+        self.remove(*database.primary_spec(obj))
+
+    def _invalidate(self, object_class, bucket):
+        self._buckets.get(object_class, {}).pop(bucket, None)
+        self._classes.pop(object_class, None)
+        self._root = None
+
+    def root(self):
+        """Digest of the whole tree."""
+        if self._root is None:
+            self._root = _combine(self.classes())
+        return self._root
+
+    def classes(self):
+        """Return dictionary of object classes and their digests."""
+        for object_class in self._leaves:
+            if object_class not in self._classes:
+                self._classes[object_class] = _combine(
+                    self.buckets(object_class))
+        return dict(self._classes)
+
+    def buckets(self, object_class):
+        """Return dictionary of buckets of an object class and their
+        digests."""
+        cache = self._buckets.setdefault(object_class, {})
+        for bucket, leaves in self._leaves.get(object_class, {}).items():
+            if bucket not in cache:
+                cache[bucket] = _combine(leaves)
+        return dict(cache)
+
+    def leaves(self, object_class, bucket):
+        """Return dictionary of object keys in a bucket and their digests."""
+        return dict(self._leaves.get(object_class, {}).get(bucket, {}))
+
+    def build(self, database, classes=None):
+        """Add all objects of a database to the tree."""
+        if hasattr(database, "find_parallel"):
+            objects = database.find_parallel(classes=classes, ordered=False)
+        else:
+            objects = database.find(classes=classes)
+        for obj in objects:
+            self.add_object(database, obj)
+        if getattr(database, "journal", None) is not None:
+            self.serial = database.journal.last_serial
+
+    def apply_changes(self, database, changes):
+        """Apply tuples of serial, operation and object, as returned by the
+        changes method of a database with journal."""
+        for serial, operation, obj in changes:
+            if operation == "ADD":
+                self.add_object(database, obj)
+            elif operation == "DEL":
+                self.remove_object(database, obj)
+            self.serial = serial
+
+    @classmethod
+    def for_database(cls, database, path=None, **kwargs):
+        """Return tree of a database. If 'path' refers to a saved tree of a
+        database with journal, only the changes since the saved serial are
+        applied, otherwise the tree is built from scratch. A saved tree with
+        a different bucket length or different ignored keys is rebuilt, too.
+        The resulting tree is saved to 'path'."""
+        tree = None
+        journal = getattr(database, "journal", None)
+        if path is not None and journal is not None:
+            try:
+                tree = cls.load(path)
+            except (FileNotFoundError, ValueError):
+                pass
+        if tree is not None and (
+                tree.bucket_length != kwargs.get("bucket_length",
+                                                 tree.bucket_length) or
+                tree.ignore_keys != tuple(kwargs.get("ignore_keys",
+                                                     tree.ignore_keys))):
+            tree = None
+        if tree is not None and tree.serial is not None and \
+                tree.serial + 1 >= journal.first_serial:
+            tree.apply_changes(database, database.changes(tree.serial))
+        else:
+            tree = cls(**kwargs)
+            tree.build(database)
+        if path is not None:
+            tree.save(path)
+        return tree
+
+    def save(self, path):
+        with open(path, "w") as fh:
+            json.dump({"bucket-length": self.bucket_length,
+                       "ignore-keys": self.ignore_keys,
+                       "serial": self.serial,
+                       "leaves": self._leaves}, fh)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as fh:
+            data = json.load(fh)
+        tree = cls(bucket_length=data["bucket-length"],
+                   ignore_keys=data["ignore-keys"])
+        tree.serial = data["serial"]
+        tree._leaves = data["leaves"]
+        return tree
+
+
+class TreeServer(socketserver.ThreadingTCPServer):
+    """Server which exposes the levels of a MerkleTree and the objects of
+    the corresponding database over a line-based JSON protocol.
+
+    The tree is brought up to date whenever a client asks for the root or
+    the classes, which starts a comparison. The changes in the journal of
+    the database are applied, or the tree is rebuilt if they are no longer
+    available. Trees of databases without journal are rebuilt at most every
+    `rebuild_interval` seconds. If `path` is given, the updated tree is
+    saved there."""
+
+    allow_reuse_address = True
+    daemon_threads = True
+    rebuild_interval = 60
+
+    def __init__(self, address, tree, database, path=None):
+        super().__init__(address, _TreeRequestHandler)
+        self.tree = tree
+        self.database = database
+        self.path = path
+        self.lock = threading.Lock()
+        self._built = time.monotonic()
+
+    def refresh(self):
+        with self.lock:
+            tree = self.tree
+            journal = getattr(self.database, "journal", None)
+            if journal is not None:
+                journal.refresh()
+                if tree.serial == journal.last_serial:
+                    return
+                if tree.serial is not None and \
+                        tree.serial < journal.last_serial and \
+                        journal.complete_since(tree.serial):
+                    tree.apply_changes(self.database,
+                                       self.database.changes(tree.serial))
+                    if self.path is not None:
+                        tree.save(self.path)
+                    return
+            elif time.monotonic() - self._built < self.rebuild_interval:
+                return
+            tree = MerkleTree(bucket_length=tree.bucket_length,
+                              ignore_keys=tree.ignore_keys)
+            tree.build(self.database)
+            self.tree = tree
+            self._built = time.monotonic()
+            if self.path is not None and journal is not None:
+                tree.save(self.path)
+
+
+class _TreeRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        server = self.server
+        for line in self.rfile:
+            request = json.loads(line)
+            op = request.get("op")
+            if op in {"root", "classes"}:
+                server.refresh()
+            if op == "fetch":
+                obj = server.database.try_fetch(request["class"],
+                                                request["key"])
+                response = obj.to_json() if obj is not None else None
+            else:
+                # Digests of the tree are computed lazily
+                with server.lock:
+                    tree = server.tree
+                    if op == "root":
+                        response = tree.root()
+                    elif op == "classes":
+                        response = tree.classes()
+                    elif op == "buckets":
+                        response = tree.buckets(request["class"])
+                    elif op == "leaves":
+                        response = tree.leaves(request["class"],
+                                               request["bucket"])
+                    else:
+                        response = None
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+
+
+class RemoteTree(object):
+    """Client for a TreeServer, which provides the same interface as a
+    MerkleTree, and fetch for the objects of the remote database."""
+
+    def __init__(self, address, port, database=None):
+        self._conn = socket.create_connection((address, port))
+        self._rfile = self._conn.makefile("rb")
+        self.database = database
+
+    def _request(self, **request):
+        self._conn.sendall(json.dumps(request).encode() + b"\n")
+        return json.loads(self._rfile.readline())
+
+    def root(self):
+        return self._request(op="root")
+
+    def classes(self):
+        return self._request(op="classes")
+
+    def buckets(self, object_class):
+        return self._request(op="buckets", **{"class": object_class})
+
+    def leaves(self, object_class, bucket):
+        return self._request(op="leaves", bucket=bucket,
+                             **{"class": object_class})
+
+    def fetch(self, object_class, object_key):
+        data = self._request(op="fetch", key=object_key,
+                             **{"class": object_class})
+        if data is None:
+            raise KeyError(repr((object_class, object_key)))
+        if self.database is not None:
+            return self.database.create_object(data)
+        import lglass.object
+        return lglass.object.Object(data)
+
+    def close(self):
+        self._rfile.close()
+        self._conn.close()
+
+
+def diff(src_tree, dst_tree):
+    """Compare two trees top down and yield tuples of operation ('ADD' or
+    'DEL'), object class and object key, which turn the destination into a
+    copy of the source."""
+    if src_tree.root() == dst_tree.root():
+        return
+    src_classes, dst_classes = src_tree.classes(), dst_tree.classes()
+    for object_class in sorted(set(src_classes) | set(dst_classes)):
+        if src_classes.get(object_class) == dst_classes.get(object_class):
+            continue
+        src_buckets = src_tree.buckets(object_class)
+        dst_buckets = dst_tree.buckets(object_class)
+        for bucket in sorted(set(src_buckets) | set(dst_buckets)):
+            if src_buckets.get(bucket) == dst_buckets.get(bucket):
+                continue
+            src_leaves = src_tree.leaves(object_class, bucket)
+            dst_leaves = dst_tree.leaves(object_class, bucket)
+            for key in sorted(set(src_leaves) | set(dst_leaves)):
+                if key not in src_leaves:
+                    yield ("DEL", object_class, key)
+                elif src_leaves[key] != dst_leaves.get(key):
+                    yield ("ADD", object_class, key)
+
+
+def sync(src, src_tree, dst, dst_tree, delete=True):
+    """Transfer the objects of all differing buckets from 'src' to 'dst' and
+    update 'dst_tree' accordingly. 'src' may be a database or a RemoteTree.
+    Yields the performed operations."""
+    for operation, object_class, object_key in list(diff(src_tree, dst_tree)):
+        if operation == "ADD":
+            obj = src.fetch(object_class, object_key)
+            dst.save(obj)
+            dst_tree.update(object_class, object_key,
+                            object_digest(obj, dst_tree.ignore_keys))
+        elif delete:
+            obj = dst.fetch(object_class, object_key)
+            dst.delete(obj)
+            dst_tree.remove(object_class, object_key)
+        else:
+            continue
+        yield operation, object_class, object_key
+
+
+def main(args=None, database_cls=None):
+    import argparse
+    import sys
+
+    if database_cls is None:
+        import lglass.nic
+        database_cls = lglass.nic.FileDatabase
+    if args is None:
+        args = sys.argv[1:]
+
+    argparser = argparse.ArgumentParser(
+        description="Synchronize databases by comparing Merkle trees")
+    argparser.add_argument("--tree", help="Path of saved tree of the local "
+                           "database")
+    argparser.add_argument("--no-delete", action="store_true")
+    argparser.add_argument("--dry-run", "-n", action="store_true")
+    subparsers = argparser.add_subparsers(dest="command")
+    serve_parser = subparsers.add_parser("serve")
+    serve_parser.add_argument("--address", "-a", default="::1")
+    serve_parser.add_argument("--port", "-p", type=int, default=4344)
+    serve_parser.add_argument("database")
+    sync_parser = subparsers.add_parser("sync")
+    sync_parser.add_argument("--source-tree", help="Path of saved tree of "
+                             "the source database, if it is local")
+    sync_parser.add_argument("source",
+                             help="Path of database or HOST:PORT of server")
+    sync_parser.add_argument("database")
+
+    args = argparser.parse_args(args)
+
+    db = database_cls(args.database)
+    tree = MerkleTree.for_database(db, path=args.tree)
+
+    if args.command == "serve":
+        with TreeServer((args.address, args.port), tree, db,
+                        path=args.tree) as server:
+            server.serve_forever()
+        return
+    elif args.command != "sync":
+        argparser.print_usage()
+        return
+
+    if ":" in args.source and not args.source.startswith(("/", ".")):
+        host, port = args.source.rsplit(":", 1)
+        src = src_tree = RemoteTree(host.strip("[]"), int(port), database=db)
+    else:
+        src = database_cls(args.source)
+        src_tree = MerkleTree.for_database(src, path=args.source_tree,
+                                          bucket_length=tree.bucket_length,
+                                          ignore_keys=tree.ignore_keys)
+
+    if args.dry_run:
+        operations = diff(src_tree, tree)
+    else:
+        operations = sync(src, src_tree, db, tree,
+                          delete=not args.no_delete)
+    for operation, object_class, object_key in operations:
+        print("{} {}:   {}".format(operation, object_class, object_key))
+    if args.tree is not None and not args.dry_run:
+        tree.save(args.tree)
+
+
+if __name__ == "__main__":
+    main()
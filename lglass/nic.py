@@ -1,12 +1,19 @@
+import collections
+import concurrent.futures
 import datetime
+import hashlib
 import os
 import re
+import time
+import weakref
 
 import dateutil.parser
 import netaddr
 
 import lglass.database
 import lglass.dns
+import lglass.iostats
+import lglass.journal
 import lglass.object
 
 
@@ -484,28 +491,233 @@ class NicDatabaseMixin(object):
         self.manifest["serial"] = new_serial
 
 
+def _read_files(paths):
+    """Read a chunk of files, telling the kernel about all of them before
+    reading the first one. Returns a list of (text, mtime) tuples, with None
+    for files which could not be read."""
+    fds = []
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            fds.append(None)
+            continue
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        fds.append(fd)
+    results = []
+    for fd in fds:
+        if fd is None:
+            results.append(None)
+            continue
+        try:
+            mtime = os.fstat(fd).st_mtime
+            with open(fd) as fh:
+                results.append((fh.read(), mtime))
+        except (OSError, ValueError):
+            results.append(None)
+    return results
+
+
+def _parse_texts(texts):
+    """Parse a list of object texts, returning a list of lists of key-value
+    tuples, with None for texts which could not be parsed."""
+    results = []
+    for text in texts:
+        try:
+            results.append(lglass.object.parse_object(text.splitlines()))
+        except (AttributeError, ValueError):
+            results.append(None)
+    return results
+
+
+# Directories modified less than a second ago are not trusted by the listing
+# cache, since further changes might not alter their mtime.
+_RACY_INTERVAL = 1000000000
+
+
+class _Listing(object):
+    """Cached listing of an object class or shard directory."""
+
+    __slots__ = ("mtime", "names")
+
+    def __init__(self, mtime, names):
+        self.mtime = mtime
+        self.names = names
+
+
 class FileDatabase(lglass.database.Database, NicDatabaseMixin):
-    """NIC database instance that fetches from a directory structure."""
+    """NIC database instance that fetches from a directory structure.
+
+    Unless `cache_listings` is False, the database keeps the set of file names
+    of every object class directory it has seen. A listing is revalidated by
+    a single stat of the directory, hence lookups of known objects don't need
+    a system call per key. Modifications through `save` and `delete` update
+    the listing in place, unless the directory was changed by another process
+    before.
+
+    Large object classes can be stored in a sharded layout, which is
+    recorded as `shard-depth` in the MANIFEST. With a shard depth of n, an
+    object is stored in n nested directories named by the leading bytes of
+    the SHA-1 hash of its file name, e.g. `person/3f/a2/foo-dn42` for a
+    depth of 2. Use `reshard` to convert an existing tree.
+
+    If the database directory contains a JOURNAL directory, or `journal` is
+    True, every change is recorded in a lglass.journal.Journal before it is
+    applied, and `serial` is the serial of the last journal entry. The
+    serial in the MANIFEST only seeds a new journal and is updated when the
+    MANIFEST is saved. Use `changes` to iterate over the changes since a
+    given serial."""
 
     _manifest = None
+    _shard_depth = None
+    # Sessions are write sessions, hence not used for queries
+    query_sessions = False
 
-    def __init__(self, path, read_only=False, case_insensitive=True):
+    def __init__(self, path, read_only=False, case_insensitive=True,
+                 cache_listings=True, journal=None):
         NicDatabaseMixin.__init__(self)
         self._path = path
         self.read_only = read_only
         self.case_insensitive = case_insensitive
+        self.cache_listings = cache_listings
+        self._listings = {}
+        self._observers = weakref.WeakSet()
+        self.journal = None
+        journal_path = os.path.join(path, "JOURNAL")
+        if journal or (journal is None and os.path.isdir(journal_path)):
+            self.journal = lglass.journal.Journal(
+                journal_path, first_serial=int(self.serial) + 1)
+
+    @property
+    def serial(self):
+        if self.journal is None:
+            return NicDatabaseMixin.serial.fget(self)
+        self.journal.refresh()
+        return self.journal.last_serial
+
+    @serial.setter
+    def serial(self, new_serial):
+        NicDatabaseMixin.serial.fset(self, new_serial)
+
+    def _file_name(self, object_key):
+        if self.case_insensitive is True:
+            object_key = object_key.lower()
+        return object_key.replace("/", "_")
+
+    @property
+    def shard_depth(self):
+        """Number of shard directory levels below each object class
+        directory, as recorded in the MANIFEST."""
+        if self._shard_depth is None:
+            self._shard_depth = int(self.manifest.getfirst("shard-depth",
+                                                           default=0))
+        return self._shard_depth
+
+    def _shard(self, name, shard_depth=None):
+        """Return the tuple of shard directory names for a file name."""
+        if shard_depth is None:
+            shard_depth = self.shard_depth
+        if not shard_depth:
+            return ()
+        digest = hashlib.sha1(name.encode()).hexdigest()
+        return tuple(digest[2 * i:2 * i + 2] for i in range(shard_depth))
+
+    def _shards(self, object_class):
+        """Generator that yields the shard tuples of all existing shard
+        directories of an object class."""
+        shards = [()]
+        for _ in range(self.shard_depth):
+            next_shards = []
+            for shard in shards:
+                path = os.path.join(self._build_path(object_class), *shard)
+                try:
+                    lglass.iostats.count("scandir")
+                    with os.scandir(path) as entries:
+                        next_shards.extend(
+                            shard + (entry.name,) for entry in entries
+                            if entry.name[0] != '.' and entry.is_dir())
+                except FileNotFoundError:
+                    continue
+            shards = sorted(next_shards)
+        yield from shards
 
     def _build_path(self, object_class, object_key=None):
         if object_key is None:
             return os.path.join(self._path, object_class)
-        if self.case_insensitive is True:
-            object_key = object_key.lower()
+        name = self._file_name(object_key)
         return os.path.join(
             self._path,
             object_class,
-            object_key.replace(
-                "/",
-                "_"))
+            *self._shard(name),
+            name)
+
+    def _listing(self, object_class, shard=()):
+        """Return the listing of an object class or shard directory,
+        rescanning it if the directory was modified since the last scan.
+        Raises FileNotFoundError if the directory does not exist."""
+        path = os.path.join(self._build_path(object_class), *shard)
+        lglass.iostats.count("stat")
+        mtime = os.stat(path).st_mtime_ns
+        listing = self._listings.get((object_class, shard))
+        if listing is not None and listing.mtime == mtime:
+            lglass.iostats.count("listing_hit")
+            return listing
+        lglass.iostats.count("scandir")
+        with os.scandir(path) as entries:
+            names = {entry.name for entry in entries if entry.name[0] != '.'}
+        # Changes within the timestamp granularity of the file system are
+        # not visible in the directory mtime, so recently modified
+        # directories are scanned again on the next lookup.
+        if time.time_ns() - mtime < _RACY_INTERVAL:
+            mtime = None
+        listing = _Listing(mtime, names)
+        self._listings[(object_class, shard)] = listing
+        return listing
+
+    def _directory_mtime(self, key):
+        object_class, shard = key
+        lglass.iostats.count("stat")
+        try:
+            return os.stat(os.path.join(self._build_path(object_class),
+                                        *shard)).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _listing_mtimes(self, specs):
+        """Return the directory mtimes of the cached listings of an iterable
+        of tuples of primary class and file name, before they are
+        changed."""
+        mtimes = {}
+        for object_class, name in specs:
+            key = (object_class, self._shard(name))
+            if key not in mtimes and key in self._listings:
+                mtimes[key] = self._directory_mtime(key)
+        return mtimes
+
+    def _update_listings(self, changes, mtimes):
+        """Apply an iterable of tuples of primary class, file name and
+        removal flag to the cached listings. Listings whose directory had
+        the cached mtime before the change, according to `mtimes`, adopt
+        the new mtime of the directory, others are scanned again on the
+        next lookup."""
+        keys = set()
+        for object_class, name, remove in changes:
+            key = (object_class, self._shard(name))
+            listing = self._listings.get(key)
+            if listing is None:
+                continue
+            if remove:
+                listing.names.discard(name)
+            else:
+                listing.names.add(name)
+            keys.add(key)
+        for key in keys:
+            listing = self._listings[key]
+            if listing.mtime is not None and listing.mtime == mtimes.get(key):
+                listing.mtime = self._directory_mtime(key)
+            else:
+                listing.mtime = None
 
     def lookup(self, classes=None, keys=None):
         if classes is None:
@@ -521,11 +733,54 @@ class FileDatabase(lglass.database.Database, NicDatabaseMixin):
                 pass
 
     def _lookup_class(self, object_class, object_keys):
+        if not self.cache_listings:
+            yield from self._lookup_class_uncached(object_class, object_keys)
+            return
+        if isinstance(object_keys, str):
+            if object_keys in {'.', '..'}:
+                return
+            object_keys = (object_keys,)
+        listings = {}
+        if not self.shard_depth:
+            # Let FileNotFoundError propagate for missing class directories
+            listings[()] = self._listing(object_class)
+        try:
+            keys_iter = iter(object_keys)
+            for key in keys_iter:
+                key = key.replace("_", "/")
+                name = self._file_name(key)
+                shard = self._shard(name)
+                try:
+                    listing = listings[shard]
+                except KeyError:
+                    try:
+                        listing = listings[shard] = self._listing(
+                            object_class, shard)
+                    except FileNotFoundError:
+                        continue
+                if name in listing.names:
+                    yield (object_class, key)
+            return
+        except TypeError:
+            pass
+        for shard in self._shards(object_class):
+            try:
+                names = list(self._listing(object_class, shard).names)
+            except FileNotFoundError:
+                continue
+            lglass.iostats.count("scan", len(names))
+            for key in names:
+                key = key.replace("_", "/")
+                if lglass.database.perform_key_match(object_keys, key):
+                    yield (object_class, key)
+
+    def _lookup_class_uncached(self, object_class, object_keys):
         if isinstance(object_keys, str):
             if object_keys in {'.', '..'}:
                 return
             object_keys = object_keys.replace("_", "/")
             try:
+                lglass.iostats.count("stat")
                 os.stat(self._build_path(object_class, object_keys))
                 yield (object_class, object_keys)
             except FileNotFoundError:
@@ -536,6 +791,7 @@ class FileDatabase(lglass.database.Database, NicDatabaseMixin):
             for key in keys_iter:
                 key = key.replace("_", "/")
                 try:
+                    lglass.iostats.count("stat")
                     os.stat(self._build_path(object_class, key))
                     yield (object_class, key)
                 except FileNotFoundError:
@@ -543,22 +799,150 @@ class FileDatabase(lglass.database.Database, NicDatabaseMixin):
             return
         except TypeError:
             pass
-        for key in os.listdir(self._build_path(object_class)):
-            if key[0] == '.':
+        if not self.shard_depth:
+            os.stat(self._build_path(object_class))
+        for shard in self._shards(object_class):
+            path = os.path.join(self._build_path(object_class), *shard)
+            try:
+                lglass.iostats.count("listdir")
+                names = os.listdir(path)
+            except FileNotFoundError:
+                continue
+            lglass.iostats.count("scan", len(names))
+            for key in names:
+                if key[0] == '.':
+                    continue
+                key = key.replace("_", "/")
+                if lglass.database.perform_key_match(object_keys, key):
+                    yield (object_class, key)
+
+    def _scan_files(self, classes=None, keys=None):
+        """Generator that yields tuples of primary class, object key and path
+        for all matching files. Complete object class directories are
+        returned in inode order, which is usually close to the on-disk
+        order."""
+        if keys is not None:
+            for object_class, object_key in self.lookup(classes, keys):
+                yield (object_class, object_key,
+                       self._build_path(object_class, object_key))
+            return
+        if classes is None:
+            classes = self.object_classes
+        elif isinstance(classes, str):
+            classes = {self.primary_class(classes)}
+        else:
+            classes = map(self.primary_class, classes)
+        for object_class in classes:
+            entries = []
+            for shard in self._shards(object_class):
+                path = os.path.join(self._build_path(object_class), *shard)
+                try:
+                    lglass.iostats.count("scandir")
+                    with os.scandir(path) as it:
+                        entries.extend((entry.inode(), entry.name, entry.path)
+                                       for entry in it
+                                       if entry.name[0] != '.')
+                except FileNotFoundError:
+                    continue
+            lglass.iostats.count("scan", len(entries))
+            entries.sort()
+            for _, name, path in entries:
+                yield (object_class, name.replace("_", "/"), path)
+
+    def iter_objects(self, classes=None, keys=None, workers=None,
+                     ordered=True, processes=True, chunk_size=64):
+        """Generator that yields all objects stored in the matching files,
+        like find, but reads the files in a pool of `workers` threads and
+        parses them in a pool of `workers` processes, unless `processes` is
+        False. Files are processed in chunks of `chunk_size` files and at most
+        two chunks per worker are in flight, hence memory usage is bounded.
+        If `ordered` is False, objects are yielded as soon as their chunk is
+        complete instead of in scan order. Files which can't be read or
+        parsed are skipped."""
+        if workers is None:
+            workers = os.cpu_count() or 1
+        parser = None
+        if processes:
+            parser = concurrent.futures.ProcessPoolExecutor(workers)
+        reader = concurrent.futures.ThreadPoolExecutor(workers)
+
+        def _process(chunk):
+            files = _read_files([path for _, _, path in chunk])
+            texts = [f[0] if f is not None else None for f in files]
+            if parser is not None:
+                datas = parser.submit(_parse_texts, texts).result()
+            else:
+                datas = _parse_texts(texts)
+            return [(object_class, data, f[1])
+                    for (object_class, _, _), f, data
+                    in zip(chunk, files, datas) if data]
+
+        def _chunks():
+            chunk = []
+            for spec in self._scan_files(classes, keys):
+                chunk.append(spec)
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+
+        pending = collections.deque()
+        try:
+            for chunk in _chunks():
+                pending.append(reader.submit(_process, chunk))
+                while len(pending) >= 2 * workers:
+                    yield from self._complete_chunk(pending, ordered)
+            while pending:
+                yield from self._complete_chunk(pending, ordered)
+        finally:
+            for future in pending:
+                future.cancel()
+            reader.shutdown()
+            if parser is not None:
+                parser.shutdown()
+
+    def _complete_chunk(self, pending, ordered):
+        if ordered:
+            future = pending.popleft()
+        else:
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            future = done.pop()
+            pending.remove(future)
+        results = future.result()
+        # Files are read and parsed in other threads and processes
+        lglass.iostats.count("open", len(results))
+        lglass.iostats.count("parse", len(results))
+        for object_class, data, mtime in results:
+            try:
+                obj = self.object_class_type(object_class)(data)
+                if obj.last_modified is None:
+                    obj.last_modified = mtime
+                if obj.source is None and self.database_name is not None:
+                    obj.source = self.database_name
+            except (IndexError, ValueError):
                 continue
-            key = key.replace("_", "/")
-            if lglass.database.perform_key_match(object_keys, key):
-                yield (object_class, key)
+            yield obj
+
+    def find_parallel(self, filter=None, classes=None, keys=None, **options):
+        """Same as find, but uses iter_objects to fetch the objects. Further
+        keyword arguments are passed to iter_objects."""
+        for obj in self.iter_objects(classes=classes, keys=keys, **options):
+            if not filter or filter(obj):
+                yield obj
 
     def fetch(self, object_class, object_key):
         object_class = self.primary_class(object_class)
         try:
             path = self._build_path(object_class, object_key)
+            lglass.iostats.count("open")
             with open(path) as fh:
+                lglass.iostats.count("parse")
                 obj = self.object_class_type(object_class).from_file(fh)
-            if obj.last_modified is None:
-                st = os.stat(path)
-                obj.last_modified = st.st_mtime
+                if obj.last_modified is None:
+                    lglass.iostats.count("stat")
+                    obj.last_modified = os.fstat(fh.fileno()).st_mtime
             if obj.source is None and self.database_name is not None:
                 obj.source = self.database_name
             return obj
@@ -567,17 +951,13 @@ class FileDatabase(lglass.database.Database, NicDatabaseMixin):
         except ValueError as verr:
             raise ValueError((object_class, object_key), *verr.args)
 
-    def save(self, obj, **options):
-        if self.read_only:
-            raise ValueError
+    def _render(self, obj, **options):
+        """Return a tuple of primary class, file name, file content and
+        modification time (or None) for an object to be saved."""
         if isinstance(obj, list):
             obj = self.create_object(obj)
         object_class = self.primary_class(obj.object_class)
-        object_key = self.primary_key(obj).replace("/", "_")
-        try:
-            os.mkdir(os.path.join(self._path, object_class))
-        except FileExistsError:
-            pass
+        name = self._file_name(self.primary_key(obj))
         save_obj = NicObject(obj.data)
         remove_last_modified = self.database_name in save_obj.get(
             "source") or not save_obj.get("source")
@@ -585,31 +965,215 @@ class FileDatabase(lglass.database.Database, NicDatabaseMixin):
             save_obj.remove("last-modified")
         if save_obj.source is not None and save_obj.source == self.database_name:
             save_obj.remove("source")
-        path = self._build_path(object_class, object_key)
-        with open(path, "w") as fh:
-            fh.write("".join(save_obj.pretty_print(**options)))
+        mtime = None
         if isinstance(obj, NicObject) and obj.last_modified is not None:
-            st = os.stat(path)
             mtime = obj.last_modified_datetime.timestamp()
+        return (object_class, name, "".join(save_obj.pretty_print(**options)),
+                mtime)
+
+    def _log(self, changes):
+        """Record an iterable of tuples of operation and object in the
+        journal, if there is one."""
+        if self.journal is None:
+            return
+        self.journal.extend(
+            (operation, self.primary_class(obj.object_class),
+             self.primary_key(obj), obj)
+            for operation, obj in changes)
+
+    def add_observer(self, observer):
+        """Register an object whose methods `update` and `delete` are called
+        with every object saved or deleted through this database, until the
+        observer is garbage collected."""
+        self._observers.add(observer)
+
+    def _notify(self, changes):
+        observers = list(self._observers)
+        if not observers:
+            return
+        for operation, obj in changes:
+            # Observers expect objects of the type of their class, like the
+            # objects returned by fetch
+            if not isinstance(obj, self.object_class_type(obj.object_class)):
+                obj = self.create_object(list(obj.items()))
+            for observer in observers:
+                if operation == "DEL":
+                    observer.delete(obj)
+                else:
+                    observer.update(obj)
+
+    def changes(self, since=0):
+        """Generator that yields tuples of serial, operation ('ADD' or 'DEL')
+        and object for all changes after the serial `since`."""
+        if self.journal is None:
+            raise ValueError("Database {!r} has no journal".format(
+                self.database_name))
+        for entry in self.journal.changes(since):
+            yield (entry["serial"], entry["operation"],
+                   self.create_object(entry["object"]))
+
+    def state(self):
+        """Return a token which changes whenever changes are recorded in the
+        journal or the MANIFEST is rewritten, possibly by another process.
+        Changes to object files without journal are not detected."""
+        serial = None
+        if self.journal is not None:
+            self.journal.refresh()
+            serial = self.journal.last_serial
+        try:
+            mtime = os.stat(os.path.join(self._path, "MANIFEST")).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        return (serial, mtime)
+
+    def save(self, obj, **options):
+        if self.read_only:
+            raise ValueError
+        if isinstance(obj, list):
+            obj = self.create_object(obj)
+        self._log([("ADD", obj)])
+        object_class, name, text, mtime = self._render(obj, **options)
+        path = self._build_path(object_class, name)
+        mtimes = self._listing_mtimes([(object_class, name)])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as fh:
+            fh.write(text)
+        if mtime is not None:
+            st = os.stat(path)
             os.utime(path, times=(st.st_atime, mtime))
+        self._update_listings([(object_class, name, False)], mtimes)
+        self._notify([("ADD", obj)])
 
     def save_manifest(self):
         if self.read_only:
             raise ValueError
         mf = self.manifest
-        with open(os.path.join(self._path, "MANIFEST"), "w") as fh:
+        if self.journal is not None:
+            mf["serial"] = self.serial
+        # Readers must never see a partially written MANIFEST
+        path = os.path.join(self._path, "MANIFEST")
+        tmp_path = os.path.join(self._path,
+                                ".MANIFEST.{}.tmp".format(os.getpid()))
+        with open(tmp_path, "w") as fh:
             fh.write("".join(mf.pretty_print()))
+        os.rename(tmp_path, path)
 
     def delete(self, obj):
         if self.read_only:
             raise ValueError
         object_class = self.primary_class(obj.object_class)
         object_key = self.primary_key(obj).replace("/", "_")
+        if self.journal is not None:
+            self._log([("DEL", self.try_fetch(object_class, object_key)
+                        or obj)])
+        name = self._file_name(object_key)
+        mtimes = self._listing_mtimes([(object_class, name)])
         os.unlink(self._build_path(object_class, object_key))
+        self._update_listings([(object_class, name, True)], mtimes)
+        self._notify([("DEL", obj)])
+
+    def session(self, batch_size=1000, fsync=True):
+        """Create a new write session, which buffers saves and deletes until
+        commit is called."""
+        return FileSession(self, batch_size=batch_size, fsync=fsync)
+
+    def _commit(self, changes, batch_size=1000, fsync=True):
+        """Apply a list of changes, which are tuples of primary class, file
+        name, file content, modification time and object, with None as
+        content for deletions. Every batch of changes is first written to temporary files,
+        which are then renamed to their final names, and the affected
+        directories are synchronized once per batch."""
+        if self.read_only:
+            raise ValueError
+        for offset in range(0, len(changes), batch_size):
+            batch = changes[offset:offset + batch_size]
+            self._log(("ADD" if text is not None else "DEL", obj)
+                      for _, _, text, _, obj in batch)
+            mtimes = self._listing_mtimes(
+                (object_class, name) for object_class, name, _, _, _ in batch)
+            directories = set()
+            renames = []
+            for object_class, name, text, mtime, _ in batch:
+                path = self._build_path(object_class, name)
+                directory = os.path.dirname(path)
+                directories.add(directory)
+                if text is None:
+                    continue
+                os.makedirs(directory, exist_ok=True)
+                tmp_path = os.path.join(
+                    directory, ".{}.{}.tmp".format(name, os.getpid()))
+                with open(tmp_path, "w") as fh:
+                    fh.write(text)
+                    fh.flush()
+                    if mtime is not None:
+                        os.utime(fh.fileno(), times=(time.time(), mtime))
+                    if fsync:
+                        os.fsync(fh.fileno())
+                renames.append((tmp_path, path))
+            for tmp_path, path in renames:
+                os.rename(tmp_path, path)
+            for object_class, name, text, mtime, _ in batch:
+                if text is None:
+                    try:
+                        os.unlink(self._build_path(object_class, name))
+                    except FileNotFoundError:
+                        pass
+            if fsync:
+                for directory in directories:
+                    fd = os.open(directory, os.O_RDONLY)
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+            self._update_listings(
+                ((object_class, name, text is None)
+                 for object_class, name, text, _, _ in batch), mtimes)
+            self._notify(("ADD" if text is not None else "DEL", obj)
+                         for _, _, text, _, obj in batch)
+
+    def reshard(self, shard_depth):
+        """Convert the database in place to a new shard depth by moving all
+        object files to their new location, removing empty shard
+        directories and recording the new depth in the MANIFEST. Objects may
+        be invisible while the conversion runs, but an interrupted
+        conversion can be completed by running it again."""
+        if self.read_only:
+            raise ValueError
+        for object_class in self.object_classes:
+            class_path = self._build_path(object_class)
+            for dirpath, dirnames, filenames in os.walk(class_path,
+                                                        topdown=False):
+                for name in filenames:
+                    if name[0] == '.':
+                        continue
+                    path = os.path.join(
+                        class_path, *self._shard(name, shard_depth), name)
+                    if path == os.path.join(dirpath, name):
+                        continue
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    os.rename(os.path.join(dirpath, name), path)
+                if dirpath != class_path:
+                    try:
+                        os.rmdir(dirpath)
+                    except OSError:
+                        pass
+        self._listings = {}
+        self._shard_depth = shard_depth
+        self.manifest.remove("shard-depth")
+        if shard_depth:
+            self.manifest.add("shard-depth", shard_depth)
+        self.save_manifest()
 
     def __contains__(self, obj):
-        primary_spec = self.primary_spec(obj)
-        return os.path.exists(self._build_path(*primary_spec))
+        object_class, object_key = self.primary_spec(obj)
+        if self.cache_listings:
+            name = self._file_name(object_key)
+            try:
+                listing = self._listing(object_class, self._shard(name))
+            except FileNotFoundError:
+                return False
+            return name in listing.names
+        return os.path.exists(self._build_path(object_class, object_key))
 
     def close(self):
         pass
@@ -626,5 +1190,120 @@ class FileDatabase(lglass.database.Database, NicDatabaseMixin):
         self._manifest = obj
         return obj
 
+
+class FileSession(lglass.database.ProxyDatabase):
+    """Write session of a FileDatabase. Saved and deleted objects are
+    buffered and visible through the session, but they are only written to
+    the database by commit, in atomic batches of `batch_size` objects.
+    Uncommitted changes are discarded by rollback and close. Other
+    attributes are looked up in the underlying database."""
+
+    search = lglass.database.Database.search
+    search_inverse = lglass.database.Database.search_inverse
+
+    def __init__(self, backend, batch_size=1000, fsync=True):
+        super().__init__(backend)
+        self.batch_size = batch_size
+        self.fsync = fsync
+        self._pending = {}
+
+    def __getattr__(self, name):
+        if name == "backend":
+            raise AttributeError(name)
+        return getattr(self.backend, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def save(self, obj, **options):
+        if self.backend.read_only:
+            raise ValueError
+        if isinstance(obj, list):
+            obj = self.backend.create_object(obj)
+        object_class, name, text, mtime = self.backend._render(obj, **options)
+        self._pending[(object_class, name)] = (obj.copy(), text, mtime)
+
+    def delete(self, obj):
+        if self.backend.read_only:
+            raise ValueError
+        object_class = self.primary_class(obj.object_class)
+        name = self.backend._file_name(self.primary_key(obj))
+        if self.backend.journal is not None:
+            obj = self.try_fetch(object_class, self.primary_key(obj)) or obj
+        self._pending[(object_class, name)] = (obj, None, None)
+
+    def fetch(self, object_class, object_key):
+        object_class = self.primary_class(object_class)
+        spec = (object_class, self.backend._file_name(object_key))
+        try:
+            obj, text, _ = self._pending[spec]
+        except KeyError:
+            return self.backend.fetch(object_class, object_key)
+        if text is None:
+            raise KeyError(repr((object_class, object_key)))
+        return obj.copy()
+
+    def lookup(self, classes=None, keys=None):
+        if not self._pending:
+            yield from self.backend.lookup(classes=classes, keys=keys)
+            return
+        if classes is None:
+            classes = set(self.object_classes)
+        elif isinstance(classes, str):
+            classes = {self.primary_class(classes)}
+        else:
+            classes = set(map(self.primary_class, classes))
+        key_names = None
+        if isinstance(keys, str):
+            key_names = {self.backend._file_name(keys.replace("_", "/"))}
+        elif keys is not None and not callable(keys):
+            keys = list(keys)
+            key_names = {self.backend._file_name(key.replace("_", "/"))
+                         for key in keys}
+        for object_class, object_key in self.backend.lookup(classes=classes,
+                                                            keys=keys):
+            spec = (object_class, self.backend._file_name(object_key))
+            if spec not in self._pending:
+                yield (object_class, object_key)
+        for (object_class, name), (_, text, _) in list(self._pending.items()):
+            if text is None or object_class not in classes:
+                continue
+            key = name.replace("_", "/")
+            if key_names is not None and name not in key_names:
+                continue
+            elif key_names is None and not \
+                    lglass.database.perform_key_match(keys, key):
+                continue
+            yield (object_class, key)
+
+    def __contains__(self, obj):
+        object_class = self.primary_class(obj.object_class)
+        spec = (object_class, self.backend._file_name(self.primary_key(obj)))
+        try:
+            return self._pending[spec][1] is not None
+        except KeyError:
+            return obj in self.backend
+
+    def commit(self):
+        """Write all buffered changes to the database."""
+        changes = [(object_class, name, text, mtime, obj)
+                   for (object_class, name), (obj, text, mtime)
+                   in self._pending.items()]
+        self.backend._commit(changes, batch_size=self.batch_size,
+                             fsync=self.fsync)
+        self._pending = {}
+
+    def rollback(self):
+        """Discard all buffered changes."""
+        self._pending = {}
+
+    def close(self):
+        self.rollback()
+
+
 __all__ = ("NicObject", "HandleObject", "InetnumObject", "ASBlockObject",
-        "RouteObject", "AutNumObject", "NicDatabaseMixin", "FileDatabase")
+        "RouteObject", "AutNumObject", "NicDatabaseMixin", "FileDatabase",
+        "FileSession")
@@ -1,6 +1,8 @@
 import datetime
+import time
 
 import lglass.database
+import lglass.iostats
 
 
 class CacheProxyDatabase(lglass.database.ProxyDatabase):
@@ -23,11 +25,14 @@ class CacheProxyDatabase(lglass.database.ProxyDatabase):
             obj, expires_at = self._cache[(object_class, object_key)]
             if expires_at is None or expires_at > datetime.datetime.now():
                 if obj is False and self.cache_presence:
+                    lglass.iostats.count("cache_hit")
                     raise KeyError(repr((object_class, object_key)))
                 elif self.cache_objects and obj is not True:
+                    lglass.iostats.count("cache_hit")
                     return obj.copy()
             else:
                 del self._cache[(object_class, object_key)]
+        lglass.iostats.count("cache_miss")
         expires_at = None
         if self.lifetime is not None:
             expires_at = datetime.datetime.now() + self.lifetime
@@ -89,3 +94,74 @@ class NotifyProxyDatabase(lglass.database.ProxyDatabase):
     def save(self, obj, **options):
         super().save(obj, **options)
         self.on_update(obj)
+
+
+class TimingProxyDatabase(lglass.database.ProxyDatabase):
+    """Proxy database, which reports every call of a query method to
+    `record(method, seconds, results)`. Besides the methods of Database,
+    the index methods of the backend (lookup_inetnum, lookup_route and
+    lookup_as_block) are timed, if the backend has them. Generators are
+    timed while they are consumed. Other attributes are looked up in the
+    underlying database."""
+
+    index_methods = {"lookup_inetnum", "lookup_route", "lookup_as_block"}
+
+    def __init__(self, backend, record):
+        super().__init__(backend)
+        self.record = record
+
+    def __getattr__(self, name):
+        if name == "backend":
+            raise AttributeError(name)
+        attr = getattr(self.backend, name)
+        if name in self.index_methods:
+            return lambda *args, **kwargs: self._call(name, attr, *args,
+                                                      **kwargs)
+        return attr
+
+    def _call(self, name, method, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = method(*args, **kwargs)
+        except Exception:
+            self.record(name, time.perf_counter() - start, 0)
+            raise
+        if hasattr(result, "__next__"):
+            return self._consume(name, result, time.perf_counter() - start)
+        elif isinstance(result, (list, tuple, set)):
+            self.record(name, time.perf_counter() - start, len(result))
+        else:
+            self.record(name, time.perf_counter() - start, 1)
+        return result
+
+    def _consume(self, name, iterator, seconds):
+        results = 0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    seconds += time.perf_counter() - start
+                results += 1
+                yield item
+        finally:
+            self.record(name, seconds, results)
+
+    def lookup(self, *args, **kwargs):
+        return self._call("lookup", self.backend.lookup, *args, **kwargs)
+
+    def fetch(self, *args, **kwargs):
+        return self._call("fetch", self.backend.fetch, *args, **kwargs)
+
+    def find(self, *args, **kwargs):
+        return self._call("find", self.backend.find, *args, **kwargs)
+
+    def search(self, *args, **kwargs):
+        return self._call("search", self.backend.search, *args, **kwargs)
+
+    def search_inverse(self, *args, **kwargs):
+        return self._call("search_inverse", self.backend.search_inverse,
+                          *args, **kwargs)
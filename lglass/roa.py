@@ -73,7 +73,7 @@ if __name__ == "__main__":
         else:
             print("flush roa")
 
-    for route in db.find(classes=classes):
+    for route in db.find_parallel(classes=classes):
         for entry in roa_entries(route):
             if args.weak_maxlen:
                 entry = list(entry)
@@ -0,0 +1,159 @@
+# coding: utf-8
+
+import collections
+
+import lglass.whois.indexes
+
+
+class AbuseContactIndex(lglass.whois.indexes.DatabaseIndex):
+    """ Precomputed abuse mailboxes of the inetnum, inet6num and aut-num
+    objects of a database, as determined by WhoisEngine.query_abuse: the
+    'abuse-c' of the object or, if there is none, the 'abuse-c' or
+    'abuse-mailbox' of its organisation.
+
+    The index is kept up to date like every DatabaseIndex. Changes of
+    organisations and contacts are propagated to the objects which refer
+    to them.
+
+    If 'inherit' is True, inetnum and inet6num objects without abuse
+    contact inherit the abuse contact of the nearest less specific object
+    of their class which has one. """
+
+    abuse_classes = frozenset(["inetnum", "inet6num", "aut-num"])
+    cidr_classes = frozenset(["inetnum", "inet6num"])
+    handle_classes = frozenset(["person", "role", "organisation"])
+
+    def __init__(self, database, inherit=False, check_interval=1):
+        super().__init__(database, check_interval=check_interval)
+        self.inherit = inherit
+        self._contacts = {}
+        self._references = {}
+        self._dependents = collections.defaultdict(set)
+        self._networks = {}
+        self._network_keys = {}
+
+    def __len__(self):
+        return len(self._contacts)
+
+    def lookup(self, obj):
+        """ Return the abuse mailbox of an object or None, if it has none.
+        Raises KeyError if the object is not indexed. """
+        self.refresh()
+        spec = self._spec(obj)
+        mailbox = self._contacts[spec]
+        if mailbox is None and self.inherit and spec[0] in self.cidr_classes:
+            mailbox = self._inherited(spec[0], obj.ip_network)
+        return mailbox
+
+    def _build(self):
+        self._contacts = {}
+        self._references = {}
+        self._dependents = collections.defaultdict(set)
+        self._networks = {}
+        self._network_keys = {}
+        memo = {}
+        for obj in self.database.find(classes=self.abuse_classes):
+            self._index(obj, memo)
+
+    def _update(self, obj):
+        object_class, object_key = self._spec(obj)
+        if object_class in self.abuse_classes:
+            self._index(obj)
+        else:
+            self._reindex_dependents(object_key)
+
+    def _delete(self, obj):
+        spec = self._spec(obj)
+        if spec[0] in self.abuse_classes:
+            self._unindex(spec)
+        else:
+            self._reindex_dependents(spec[1])
+
+    def _network_key(self, object_class, net):
+        return (object_class, net.version, net.first, net.prefixlen)
+
+    def _inherited(self, object_class, net):
+        width = 32 if net.version == 4 else 128
+        first = net.first
+        for prefixlen in range(net.prefixlen - 1, -1, -1):
+            first &= ~((1 << (width - prefixlen)) - 1)
+            spec = self._networks.get(
+                (object_class, net.version, first, prefixlen))
+            if spec is not None and self._contacts.get(spec) is not None:
+                return self._contacts[spec]
+
+    def _index(self, obj, memo=None):
+        spec = self._spec(obj)
+        self._unindex(spec)
+        mailbox, references = self._resolve(obj, memo)
+        self._contacts[spec] = mailbox
+        self._references[spec] = references
+        for reference in references:
+            self._dependents[reference].add(spec)
+        if spec[0] in self.cidr_classes:
+            network_key = self._network_key(spec[0], obj.ip_network)
+            self._networks[network_key] = spec
+            self._network_keys[spec] = network_key
+
+    def _unindex(self, spec):
+        if self._contacts.pop(spec, False) is False:
+            return
+        for reference in self._references.pop(spec, ()):
+            dependents = self._dependents.get(reference)
+            if dependents is not None:
+                dependents.discard(spec)
+                if not dependents:
+                    del self._dependents[reference]
+        network_key = self._network_keys.pop(spec, None)
+        if network_key is not None and self._networks.get(network_key) == spec:
+            del self._networks[network_key]
+
+    def _reindex_dependents(self, object_key):
+        for spec in list(self._dependents.get(object_key.lower(), ())):
+            obj = self.database.try_fetch(*spec)
+            if obj is None:
+                self._unindex(spec)
+            else:
+                self._index(obj)
+
+    def _fetch(self, object_class, key, memo):
+        """ Fetch an object of a class, or find an object of a frozenset of
+        classes, with memoization during builds. """
+        if memo is not None and (object_class, key) in memo:
+            return memo[(object_class, key)]
+        if isinstance(object_class, str):
+            obj = self.database.try_fetch(object_class, key)
+        else:
+            obj = next(iter(self.database.find(classes=object_class,
+                                               keys=(key,))), None)
+        if memo is not None:
+            memo[(object_class, key)] = obj
+        return obj
+
+    def _resolve(self, obj, memo=None):
+        """ Return the abuse mailbox of an object and the set of the
+        lowercased keys of the objects it depends on. """
+        references = set()
+        abuse_contact_key = None
+        if "abuse-c" in obj:
+            abuse_contact_key = obj["abuse-c"]
+        elif "org" in obj:
+            references.add(obj["org"].lower())
+            org = self._fetch("organisation", obj["org"], memo)
+            if not org:
+                return None, references
+            if "abuse-c" in org:
+                abuse_contact_key = org["abuse-c"]
+            elif "abuse-mailbox" in org:
+                return org["abuse-mailbox"], references
+        if not abuse_contact_key:
+            return None, references
+        references.add(abuse_contact_key.lower())
+        abuse_contact = self._fetch(self.handle_classes, abuse_contact_key,
+                                    memo)
+        if abuse_contact and "abuse-mailbox" in abuse_contact:
+            return abuse_contact["abuse-mailbox"], references
+        return None, references
+
+
+__all__ = ("AbuseContactIndex",)
@@ -10,7 +10,7 @@ class WhoisClient(object):
         self.address = address
         self.port = port
         self.flavour = flavour
-        self.database = None
+        self.database = database
 
     def create_object(self, data, object_class=None):
         if self.database is not None:
@@ -58,3 +58,123 @@ class WhoisClient(object):
         response = response.decode().splitlines()
         for obj in lglass.object.parse_objects(response):
             yield self.create_object(obj)
+
+    def mirror(self, source, first, last="LAST", keepalive=False,
+               batches=False):
+        """Request a NRTMv3 stream of the changes of a source from serial
+        'first' to 'last' and yield tuples of serial, operation and object.
+        With 'keepalive', the connection is kept open and new changes are
+        yielded as they are pushed by the server. With 'batches', lists of
+        the changes of every block sent by the server are yielded."""
+        query = "-g {}:3:{}-{}".format(source, first, last)
+        if keepalive:
+            query = "-k " + query
+        with socket.create_connection((self.address, self.port)) as conn:
+            conn.sendall(query.encode() + b"\n")
+            with conn.makefile("r") as fh:
+                for item in parse_nrtm(fh, batches=batches):
+                    if batches:
+                        yield [(serial, operation, self.create_object(data))
+                               for serial, operation, data in item]
+                    else:
+                        serial, operation, data = item
+                        yield serial, operation, self.create_object(data)
+
+
+def parse_nrtm(lines, batches=False):
+    """Generator that parses a NRTMv3 stream, yielding tuples of serial,
+    operation and the object as list of key-value-tuples. If 'batches' is
+    True, lists of these tuples are yielded instead, one for every block
+    that ends with %END. Raises ValueError for error messages."""
+    operation = None
+    obj = []
+    batch = []
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if operation is None:
+            if line.startswith("%ERROR"):
+                raise ValueError(line)
+            elif line.startswith(("ADD ", "DEL ")):
+                operation, serial = line.split()
+                serial = int(serial)
+            elif line.startswith("%END") and batches and batch:
+                yield batch
+                batch = []
+            continue
+        if line.strip():
+            obj.append(line)
+        elif obj:
+            change = (serial, operation, lglass.object.parse_object(obj))
+            if batches:
+                batch.append(change)
+            else:
+                yield change
+            operation = None
+            obj = []
+    if operation is not None and obj:
+        change = (serial, operation, lglass.object.parse_object(obj))
+        if batches:
+            batch.append(change)
+        else:
+            yield change
+    if batch:
+        yield batch
+
+
+def apply_changes(database, changes):
+    """Apply tuples of serial, operation and object to a database and return
+    the last applied serial."""
+    serial = None
+    for serial, operation, obj in changes:
+        if operation == "ADD":
+            database.save(obj)
+        elif operation == "DEL" and obj in database:
+            database.delete(obj)
+    return serial
+
+
+def main(args=None, database_cls=None):
+    import argparse
+    import sys
+
+    if database_cls is None:
+        import lglass.nic
+        database_cls = lglass.nic.FileDatabase
+    if args is None:
+        args = sys.argv[1:]
+
+    argparser = argparse.ArgumentParser(
+        description="Mirror a source into a database using NRTMv3")
+    argparser.add_argument("--port", "-p", type=int, default=43)
+    argparser.add_argument("--database", "-D", help="Path to database",
+                           default=".")
+    argparser.add_argument("--first", type=int,
+                           help="First serial, defaults to the serial after "
+                           "the last mirrored serial")
+    argparser.add_argument("--keepalive", "-k", action="store_true",
+                           help="keep connection open and apply new changes")
+    argparser.add_argument("host")
+    argparser.add_argument("source")
+
+    args = argparser.parse_args(args)
+
+    db = database_cls(args.database)
+    first = args.first
+    if first is None:
+        first = int(db.manifest.getfirst("mirror-serial", default=0)) + 1
+    client = WhoisClient(args.host, args.port, database=db)
+    batches = client.mirror(args.source, first, keepalive=args.keepalive,
+                            batches=True)
+    # Record the mirrored serial after every batch, since a keepalive
+    # stream never ends
+    for batch in batches:
+        serial = apply_changes(db, batch)
+        for change_serial, operation, obj in batch:
+            print("{} {} {}".format(operation, change_serial,
+                                    db.primary_key(obj)))
+        db.manifest["mirror-serial"] = serial
+        db.save_manifest()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,128 @@
 import argparse
+import contextlib
+import functools
 import re
 import sys
+import threading
+import time
 
 import netaddr
 
 import lglass.database
 import lglass.dns
+import lglass.iostats
 import lglass.nic
 import lglass.schema
 import lglass.proxy
+import lglass.whois.explain
+import lglass.whois.indexes
+import lglass.whois.profiling
 
 
-def _hint_match(hint, query):
-    return re.match(hint, query)
+class QueryTimeout(Exception):
+    """ Raised by WhoisEngine.query_lazy when the deadline of a query has
+    passed. """
+
+
+class _QueryCancelled(Exception):
+    pass
+
+
+class StageTimer(object):
+    """ Accumulates the time spent in the stages of queries and the number
+    of objects they produced. An instance can be passed to
+    WhoisEngine.query_lazy and query_abuse as 'timer'. The stages are
+    'classify', 'primary', 'less-specific', 'more-specific', 'related',
+    'reverse-domain' and 'abuse'. """
+
+    def __init__(self):
+        self.seconds = {}
+        self.counts = {}
+
+    def add(self, stage, seconds, count=0):
+        self.seconds[stage] = self.seconds.get(stage, 0) + seconds
+        self.counts[stage] = self.counts.get(stage, 0) + count
+
+    def wrap(self, stage, iterable):
+        """ Generator which yields from 'iterable' and accounts the time
+        spent in it to 'stage'. """
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(stage, time.perf_counter() - start)
+                return
+            self.add(stage, time.perf_counter() - start, 1)
+            yield item
+
+    def items(self):
+        return sorted(self.seconds.items(), key=lambda i: -i[1])
+
+
+class QueryClassifier(object):
+    """ Classifies queries into lookup plans. A plan is a tuple of candidate
+    lookups in the order of precedence, which are tuples of a kind and an
+    argument: ('aut-num', asn), ('as-block', primary key), ('key', class)
+    for key prefixes and suffixes, ('network', IPNetwork), ('range', tuple
+    of IPNetworks), ('hint', class) for type hints and finally ('any',
+    None). The classifier is compiled from a sequence of tuples of 'prefix'
+    or 'suffix', the affix and the class, and a dictionary of type hints,
+    and caches the plans of the last 'cache_size' queries. """
+
+    _asn = re.compile(r"as[0-9]+$")
+    _network = re.compile(r"[0-9a-fA-F:.]+(/[0-9a-fA-F:.]+)?\s*$")
+    _range = re.compile(r"\s*[0-9a-fA-F:.]+\s*-\s*[0-9a-fA-F:.]+\s*$")
+
+    def __init__(self, key_affixes=(), type_hints=None, cache_size=4096):
+        self._prefixes = {}
+        self._suffixes = {}
+        for precedence, (kind, affix, cls) in enumerate(key_affixes):
+            table = self._suffixes if kind == "suffix" else self._prefixes
+            table.setdefault(affix, (precedence, cls))
+        self._prefix_lengths = sorted({len(p) for p in self._prefixes})
+        self._suffix_lengths = sorted({len(s) for s in self._suffixes})
+        self._hints = []
+        if type_hints is not None:
+            self._hints = [(re.compile(hint), cls)
+                           for hint, cls in type_hints.items()]
+        self.classify = functools.lru_cache(maxsize=cache_size)(
+            self._classify)
+
+    def _classify(self, query):
+        if self._asn.match(query):
+            return (("aut-num", lglass.nic.parse_asn(query)),)
+        plan = []
+        if lglass.nic.parse_as_block(query):
+            k = lglass.nic.ASBlockObject([("as-block", query)])
+            plan.append(("as-block", k.primary_key))
+        keys = []
+        for n in self._prefix_lengths:
+            if query[:n] in self._prefixes:
+                keys.append(self._prefixes[query[:n]])
+        for n in self._suffix_lengths:
+            if query[-n:] in self._suffixes:
+                keys.append(self._suffixes[query[-n:]])
+        plan.extend(("key", cls) for _, cls in sorted(keys))
+        if self._network.match(query):
+            try:
+                plan.append(("network", netaddr.IPNetwork(query)))
+                return tuple(plan)
+            except netaddr.core.AddrFormatError:
+                pass
+        if self._range.match(query):
+            try:
+                netrange = lglass.nic.parse_ip_range(query)
+                plan.append(("range", tuple(netrange.cidrs())))
+            except (netaddr.core.AddrFormatError, IndexError, ValueError):
+                pass
+        for hint, cls in self._hints:
+            if hint.match(query):
+                plan.append(("hint", cls))
+                return tuple(plan)
+        plan.append(("any", None))
+        return tuple(plan)
 
 
 class WhoisEngine(object):
@@ -23,6 +133,20 @@ class WhoisEngine(object):
     handle_classes = {"person", "role", "organisation"}
     network_classes = cidr_classes | route_classes | address_classes
     abuse_classes = {"inetnum", "inet6num", "aut-num"} | address_classes
+    key_affixes = (
+        ("prefix", "org-", "organisation"),
+        ("suffix", "-mnt", "mntner"),
+        ("prefix", "as-", "as-set"),
+        ("prefix", "rs-", "route-set"),
+        ("prefix", "rtrs-", "rtr-set"),
+        ("prefix", "fltr-", "filter-set"),
+        ("prefix", "prng-", "peering-set"),
+        ("prefix", "irt-", "irt"),
+        ("prefix", "seg-", "segment"))
+    plan_cache_size = 4096
+    filter_cache_size = 1024
+    related_cache_size = 4096
+    more_specific_limit = None
 
     def __init__(self, database=None, use_schemas=False, type_hints=None,
                  global_cache=None, query_cache=True,
@@ -43,6 +167,13 @@ class WhoisEngine(object):
         self.ipv4_more_specific_prefixlens = ipv4_more_specific_prefixlens
         self.ipv6_more_specific_prefixlens = ipv6_more_specific_prefixlens
         self.case_insensitive = case_insensitive
+        self._classifier = None
+        self._classifier_hints = None
+        self._filter_cache = {}
+        # AbuseContactIndex and PrefixIndex instances by database name
+        self.abuse_indexes = {}
+        self.prefix_indexes = {}
+        self._prefix_index_lock = threading.Lock()
 
     def __repr__(self):
         return f"WhoisEngine(database={self.database!r}, "\
@@ -56,7 +187,8 @@ class WhoisEngine(object):
     def new_query_database(self, database=None):
         if database is None:
             database = self.database
-        if hasattr(database, "session"):
+        if hasattr(database, "session") and \
+                getattr(database, "query_sessions", True):
             return database.session()
         elif hasattr(database, "close"):
             return database
@@ -72,8 +204,40 @@ class WhoisEngine(object):
         raise TypeError("positional argument 'database' required for unbound"
                         " whois engine")
 
+    @property
+    def classifier(self):
+        """ The QueryClassifier of the engine, which is compiled again when
+        the type hints change. """
+        if self._classifier is None or \
+                self._classifier_hints != self.type_hints:
+            self._classifier_hints = dict(self.type_hints)
+            self._classifier = QueryClassifier(
+                self.key_affixes, self.type_hints,
+                cache_size=self.plan_cache_size)
+        return self._classifier
+
     def filter_classes(self, classes, *other_class_sets, database=None):
+        """ Returns the frozenset of primary classes of the database, which
+        are in 'classes' and all 'other_class_sets', resolving the pseudo
+        classes 'nic-hdl', 'cidr' and 'address'. Results are cached by
+        the classes and the identity of the object classes and synonyms of
+        the database, which are replaced rather than modified. """
         database = self._get_database(database)
+        if classes is not None and not isinstance(classes, str):
+            classes = frozenset(classes)
+        object_classes = database.object_classes
+        class_synonyms = database.class_synonyms
+        key = (classes, tuple(frozenset(c) for c in other_class_sets),
+               id(object_classes), id(class_synonyms))
+        try:
+            cached_classes, cached_synonyms, result = self._filter_cache[key]
+        except KeyError:
+            pass
+        else:
+            # The cache keeps both objects alive, hence their ids are unique
+            if cached_classes is object_classes and \
+                    cached_synonyms is class_synonyms:
+                return result
         if classes is None:
             classes = set(database.object_classes)
         elif isinstance(classes, str):
@@ -88,21 +252,81 @@ class WhoisEngine(object):
             classes.update(self.cidr_classes)
         if "address" in classes:
             classes.update(self.address_classes)
-        classes = set(database.primary_class(c)
-                      for c in classes).intersection(database.object_classes)
+        classes = frozenset(database.primary_class(c) for c in classes)\
+            .intersection(object_classes)
+        if len(self._filter_cache) >= self.filter_cache_size:
+            self._filter_cache.clear()
+        self._filter_cache[key] = (object_classes, class_synonyms, classes)
         return classes
 
     def query_lazy(self, query, classes=None, reverse_domain=False,
                    related=True, less_specific_levels=0, exact_match=False,
-                   database=None, more_specific_levels=0, sources=None):
+                   database=None, more_specific_levels=0, sources=None,
+                   deadline=None, cancelled=None, timer=None):
+        """ Generator of tuples of role and object for a query. 'deadline'
+        is a time.monotonic() timestamp, after which QueryTimeout is raised,
+        and 'cancelled' an event, which stops the query when set. Both are
+        checked between results and while scanning the database. The time
+        spent in the stages of the query is accounted to 'timer', which is
+        a StageTimer. """
+        kwargs = dict(classes=classes, reverse_domain=reverse_domain,
+                      related=related,
+                      less_specific_levels=less_specific_levels,
+                      exact_match=exact_match, database=database,
+                      more_specific_levels=more_specific_levels, timer=timer)
+        if deadline is None and cancelled is None:
+            yield from self._query_lazy(query, **kwargs)
+            return
+
+        def checkpoint():
+            if cancelled is not None and cancelled.is_set():
+                raise _QueryCancelled
+            if deadline is not None and time.monotonic() > deadline:
+                raise QueryTimeout
+
+        results = self._query_lazy(query, checkpoint=checkpoint, **kwargs)
+        try:
+            while True:
+                # Scans of the database call the checkpoint for every object,
+                # but its scope must not leak to the consumer
+                with lglass.database.checkpoint_scope(checkpoint):
+                    try:
+                        result = next(results)
+                    except StopIteration:
+                        return
+                checkpoint()
+                yield result
+        except _QueryCancelled:
+            return
+        finally:
+            results.close()
+
+    def _query_lazy(self, query, classes=None, reverse_domain=False,
+                    related=True, less_specific_levels=0, exact_match=False,
+                    database=None, more_specific_levels=0, checkpoint=None,
+                    timer=None):
+        if timer is not None:
+            start = time.perf_counter()
+
+            def _stage(stage, iterable):
+                return timer.wrap(stage, iterable)
+        else:
+            def _stage(stage, iterable):
+                return iterable
+
         database = self._get_database(database)
         classes = self.filter_classes(classes, database=database)
         primary_classes = set(classes)
+        # Related objects are resolved once per query
+        resolved = {}
         if database.primary_class("domain") in primary_classes or \
                 (self.address_classes & primary_classes and more_specific_levels):
             pass
+        if timer is not None:
+            timer.add("classify", time.perf_counter() - start)
 
         if isinstance(query, tuple) and len(query) == 2:
+            lglass.whois.explain.note("inverse: search_inverse")
             primary_results = self.query_search_inverse(
                 query,
                 classes=primary_classes,
@@ -113,38 +337,51 @@ class WhoisEngine(object):
                 classes=primary_classes,
                 database=database,
                 exact_match=exact_match)
+        primary_results = _stage("primary", primary_results)
 
         for obj in primary_results:
             if obj.object_class in self.cidr_classes and less_specific_levels:
-                for lobj in self.query_less_specifics(
-                        obj,
-                        levels=less_specific_levels,
-                        database=database):
+                less_specifics = _stage("less-specific",
+                                        self.query_less_specifics(
+                                            obj,
+                                            levels=less_specific_levels,
+                                            database=database))
+                for lobj in less_specifics:
                     yield ('primary', lobj)
                     if related:
-                        for iv in self.query_related(lobj, database=database):
+                        for iv in _stage("related", self.query_related(
+                                lobj, database=database, resolved=resolved)):
                             yield ('related', iv)
             yield ('primary', obj)
             if related:
-                for iv in self.query_related(obj, database=database):
+                for iv in _stage("related", self.query_related(
+                        obj, database=database, resolved=resolved)):
                     yield ('related', iv)
             if obj.object_class in self.cidr_classes and more_specific_levels:
-                for lobj in self.query_more_specifics(
-                        obj,
-                        levels=more_specific_levels,
-                        database=database):
+                more_specifics = _stage("more-specific",
+                                        self.query_more_specifics(
+                                            obj,
+                                            levels=more_specific_levels,
+                                            database=database,
+                                            checkpoint=checkpoint,
+                                            limit=self.more_specific_limit))
+                for lobj in more_specifics:
                     yield ('primary', lobj)
                     if related:
-                        for iv in self.query_related(lobj, database=database):
+                        for iv in _stage("related", self.query_related(
+                                lobj, database=database, resolved=resolved)):
                             yield ('related', iv)
             if reverse_domain and obj.object_class in self.cidr_classes:
-                for lobj in self.query_reverse_domains(
-                        obj.ip_network,
-                        database=database,
-                        classes=classes):
+                reverse_domains = _stage("reverse-domain",
+                                         self.query_reverse_domains(
+                                             obj.ip_network,
+                                             database=database,
+                                             classes=classes))
+                for lobj in reverse_domains:
                     yield ('primary', lobj)
                     if related:
-                        for iv in self.query_related(lobj, database=database):
+                        for iv in _stage("related", self.query_related(
+                                lobj, database=database, resolved=resolved)):
                             yield ('related', iv)
 
     def query(self, *args, **kwargs):
@@ -172,77 +409,52 @@ class WhoisEngine(object):
         if self.case_insensitive:
             query = query.lower()
 
-        if re.match(r"as[0-9]+$", query):
-            asn = lglass.nic.parse_asn(query)
-            if "as-block" in classes and hasattr(database, "lookup_as_block") \
-                    and not exact_match:
-                for class_, key in database.lookup_as_block(asn):
-                    yield database.fetch(class_, key)
-            elif "as-block" in classes and not exact_match:
-                for as_block in database.find(classes=("as-block",)):
-                    if asn in as_block:
-                        yield as_block
-            if "aut-num" in classes:
-                yield from database.find(keys=(query,), classes=("aut-num",))
-            return
-        elif lglass.nic.parse_as_block(query) and "as-block" in classes:
-            k = lglass.nic.ASBlockObject([("as-block", query)])
-            yield from database.find(
-                keys=(k.primary_key,), classes=("as-block",))
-            return
-        elif query.startswith("org-") and "organisation" in classes:
-            yield from database.find(keys=(query,), classes=("organisation",))
-            return
-        elif query.endswith("-mnt") and "mntner" in classes:
-            yield from database.find(keys=(query,), classes=("mntner",))
-            return
-        elif query.startswith("as-") and "as-set" in classes:
-            yield from database.find(keys=(query,), classes=("as-set",))
-            return
-        elif query.startswith("rs-") and "route-set" in classes:
-            yield from database.find(keys=(query,), classes=("route-set",))
-            return
-        elif query.startswith("rtrs-") and "rtr-set" in classes:
-            yield from database.find(keys=(query,), classes=("rtr-set",))
-            return
-        elif query.startswith("fltr-") and "filter-set" in classes:
-            yield from database.find(keys=(query,), classes=("filter-set",))
-            return
-        elif query.startswith("prng-") and "peering-set" in classes:
-            yield from database.find(keys=(query,), classes=("peering-set",))
-            return
-        elif query.startswith("irt-") and "irt" in classes:
-            yield from database.find(keys=(query,), classes=("irt",))
-            return
-        elif query.startswith("seg-") and "segment" in classes:
-            yield from database.find(keys=(query,), classes=("segment",))
-            return
-
-        try:
-            net = netaddr.IPNetwork(query)
-            yield from self.query_network(
-                net, classes=classes,
-                exact_match=exact_match, database=database)
-            return
-        except netaddr.core.AddrFormatError:
-            pass
-        try:
-            netrange = lglass.nic.parse_ip_range(query)
-            for net in netrange.cidrs():
+        for kind, arg in self.classifier.classify(query):
+            if kind == "aut-num":
+                if "as-block" in classes and \
+                        hasattr(database, "lookup_as_block") and \
+                        not exact_match:
+                    lglass.whois.explain.note("primary: as-block index")
+                    for class_, key in database.lookup_as_block(arg):
+                        yield database.fetch(class_, key)
+                elif "as-block" in classes and not exact_match:
+                    lglass.whois.explain.note("primary: as-block scan")
+                    for as_block in database.find(classes=("as-block",)):
+                        if arg in as_block:
+                            yield as_block
+                if "aut-num" in classes:
+                    lglass.whois.explain.note("primary: aut-num key")
+                    yield from database.find(keys=(query,),
+                                             classes=("aut-num",))
+                return
+            elif kind == "as-block" and "as-block" in classes:
+                lglass.whois.explain.note("primary: as-block key")
+                yield from database.find(keys=(arg,), classes=("as-block",))
+                return
+            elif kind == "key" and arg in classes:
+                lglass.whois.explain.note("primary: {} key".format(arg))
+                yield from database.find(keys=(query,), classes=(arg,))
+                return
+            elif kind == "network":
+                lglass.whois.explain.note("primary: network")
                 yield from self.query_network(
-                    net,
-                    classes=classes,
+                    arg, classes=classes,
                     exact_match=exact_match, database=database)
-                pass
-        except (netaddr.core.AddrFormatError, IndexError, ValueError):
-            pass
-
-        for hint, cls in self.type_hints.items():
-            if _hint_match(hint, query):
-                yield from database.find(keys=(query,), classes=(cls,))
                 return
-
-        yield from database.find(keys=(query,), classes=classes)
+            elif kind == "range":
+                lglass.whois.explain.note("primary: address range")
+                for net in arg:
+                    yield from self.query_network(
+                        net,
+                        classes=classes,
+                        exact_match=exact_match, database=database)
+            elif kind == "hint":
+                lglass.whois.explain.note("primary: type hint {}".format(arg))
+                yield from database.find(keys=(query,), classes=(arg,))
+                return
+            elif kind == "any":
+                lglass.whois.explain.note("primary: key in all classes")
+                yield from database.find(keys=(query,), classes=classes)
 
     def query_network(self, net, classes=None, exact_match=False,
                       database=None):
@@ -267,17 +479,22 @@ class WhoisEngine(object):
         addresses = database.find(classes=address_classes, keys=(str(net.ip),))
         inetnums = []
         if exact_match:
+            lglass.whois.explain.note("network: exact key")
             inetnums = database.lookup(
                 classes=inetnum_classes, keys=(
                     str(net),))
         elif hasattr(database, "lookup_inetnum") and inetnum_classes:
+            lglass.whois.explain.note("network: lookup_inetnum index")
             inetnums = database.lookup_inetnum(net, limit=1)
         elif inetnum_classes:
+            lglass.whois.explain.note("network: supernet keys")
             inetnums = database.lookup(classes=inetnum_classes, keys=supernets)
         routes = []
         if hasattr(database, "lookup_route") and route_classes:
+            lglass.whois.explain.note("network: lookup_route index")
             routes = database.lookup_route(net)
         elif route_classes:
+            lglass.whois.explain.note("network: route key scan")
             routes = database.lookup(
                 classes=route_classes,
                 keys=lambda s: s.startswith(tuple(supernets)))
@@ -301,8 +518,12 @@ class WhoisEngine(object):
             if net in route.ip_network:
                 yield route
 
-    def query_related(self, obj, database=None):
-        database = self._get_database(database)
+    def related_references(self, obj):
+        """ Returns the references of an object to related objects as list
+        of tuples of classes and a key, in the order in which they are
+        resolved. The classes are either a single class, whose object is
+        fetched, or a frozenset of classes, in which the key is looked
+        up. """
         schema = None
         if self.use_schemas:
             try:
@@ -310,6 +531,7 @@ class WhoisEngine(object):
             except KeyError:
                 pass
         if schema is not None:
+            lglass.whois.explain.note("related: schema")
             inverse_objects = set()
             for key, _, _, inverse in schema.schema_keys():
                 if "nic-hdl" in inverse:
@@ -325,30 +547,77 @@ class WhoisEngine(object):
                 for value in obj.get(key):
                     for inv in inverse:
                         inverse_objects.add((inv, value))
-            for object_class, object_type in sorted(inverse_objects):
-                obj = database.try_fetch(object_class, object_type)
-                if obj:
-                    yield obj
-            return
+            return sorted(inverse_objects)
 
         # Use default rules
+        lglass.whois.explain.note("related: default rules")
         inverse_objects = set()
         inverse_objects.update(obj.get("admin-c"))
         inverse_objects.update(obj.get("tech-c"))
         inverse_objects.update(obj.get("zone-c"))
         inverse_objects.update(obj.get("org"))
-        for inverse in inverse_objects:
-            yield from database.find(classes=self.handle_classes,
-                                     keys=(inverse,))
+        handle_classes = frozenset(self.handle_classes)
+        return [(handle_classes, inverse) for inverse in inverse_objects]
 
-    def query_abuse(self, obj, database=None):
+    def resolve_references(self, references, database=None, resolved=None):
+        """ Resolves references, as returned by related_references, to lists
+        of objects and returns them as dictionary. References, which are
+        already in the dictionary 'resolved', are not resolved again. """
+        database = self._get_database(database)
+        if resolved is None:
+            resolved = {}
+        for reference in references:
+            if reference in resolved:
+                lglass.whois.explain.note("related: reused")
+                continue
+            classes, key = reference
+            if isinstance(classes, str):
+                obj = database.try_fetch(classes, key)
+                resolved[reference] = [obj] if obj else []
+            else:
+                resolved[reference] = list(database.find(classes=classes,
+                                                         keys=(key,)))
+        return resolved
+
+    def query_related(self, obj, database=None, resolved=None):
+        """ Generator of the objects related to an object. Resolved
+        references are stored in the dictionary 'resolved', if given, and
+        reused for other objects. """
+        database = self._get_database(database)
+        references = self.related_references(obj)
+        if resolved is None:
+            resolved = {}
+        elif len(resolved) >= self.related_cache_size:
+            resolved.clear()
+        self.resolve_references(references, database=database,
+                                resolved=resolved)
+        for reference in references:
+            yield from resolved[reference]
+
+    def query_abuse(self, obj, database=None, timer=None):
+        if timer is not None:
+            start = time.perf_counter()
+            try:
+                return self.query_abuse(obj, database=database)
+            finally:
+                timer.add("abuse", time.perf_counter() - start, 1)
         database = self._get_database(database)
         if obj.object_class not in self.abuse_classes:
             return
+        index = self.abuse_indexes.get(database.database_name)
+        if index is not None:
+            try:
+                mailbox = index.lookup(obj)
+                lglass.whois.explain.note("abuse: index")
+                return mailbox
+            except KeyError:
+                pass
         abuse_contact_key = None
         if "abuse-c" in obj:
+            lglass.whois.explain.note("abuse: abuse-c")
             abuse_contact_key = obj["abuse-c"]
         elif "org" in obj:
+            lglass.whois.explain.note("abuse: organisation")
             org = database.try_fetch("organisation", obj["org"])
             if not org:
                 return
@@ -378,32 +647,89 @@ class WhoisEngine(object):
             net = netaddr.IPNetwork(term)
         except netaddr.core.AddrFormatError:
             return
+        lglass.whois.explain.note("reverse-domain: rdns keys")
         for subnet, domain in lglass.dns.rdns_subnets(net):
             try:
                 yield database.fetch(domain_class, domain)
             except KeyError:
                 pass
 
-    def query_more_specifics(self, obj_or_net, levels=1, database=None):
+    def query_more_specifics(self, obj_or_net, levels=1, database=None,
+                             checkpoint=None, limit=None):
+        """ Generator of the objects more specific than an object or
+        network, up to 'levels' levels below, or all levels if 'levels' is
+        negative, in address order. At most 'limit' objects are returned.
+        Without lookup_inetnum, the PrefixIndex of the database in
+        'prefix_indexes' is used, which is built from the primary keys of
+        the database and registered on first use if the database has a
+        journal. """
         database = self._get_database(database)
         if isinstance(obj_or_net, lglass.object.Object):
             if obj_or_net.type not in self.cidr_classes:
                 return
             classes = {obj_or_net.type} | self.address_classes
             net = obj_or_net.ip_network
+            span = obj_or_net.ip_range
         else:
             classes = self.address_classes | self.cidr_classes
-            net = obj_or_net
+            net = span = obj_or_net
         if hasattr(database, "lookup_inetnum") and self.cidr_classes | classes:
+            lglass.whois.explain.note("more-specific: lookup_inetnum index")
             for class_, key in database.lookup_inetnum(net, relation='<<',
                     order='ASC'):
                 yield database.fetch(class_, key)
             return
-        res = []
-        for rel in database.find(classes=classes):
-            if rel.ip_network in net:
-                res.append(rel)
-        yield from sorted(res, key=lambda o: o.ip_network)
+        classes = self.filter_classes(classes, database=database)
+        index = self._prefix_index(database, classes)
+        n = 0
+        for class_, key in index.more_specifics(span, classes=classes,
+                                                levels=levels, limit=limit):
+            if checkpoint is not None:
+                checkpoint()
+            try:
+                obj = database.fetch(class_, key)
+            except (KeyError, ValueError):
+                continue
+            n += 1
+            yield obj
+        if limit is not None and n >= limit:
+            lglass.whois.explain.note(
+                "more-specific: limited to {}".format(limit))
+
+    def _prefix_index(self, database, classes):
+        """ Returns the PrefixIndex for the database, which covers
+        'classes', and builds and registers it if there is none. Only
+        indexes of databases with journal are registered, since changes of
+        other databases can't be followed, hence they are built for every
+        query. """
+        index = self.prefix_indexes.get(database.database_name)
+        if index is None or not classes <= index.classes:
+            # Indexes outlive the query, hence they are built on the
+            # underlying database instead of sessions and proxies
+            backend = database
+            while isinstance(backend, lglass.database.ProxyDatabase):
+                backend = backend.backend
+            if getattr(backend, "journal", None) is None:
+                lglass.whois.explain.note("more-specific: query index")
+                index = lglass.whois.indexes.PrefixIndex(database,
+                                                         classes=classes)
+                index.build()
+                return index
+            with self._prefix_index_lock:
+                index = self.prefix_indexes.get(database.database_name)
+                if index is None or not classes <= index.classes:
+                    lglass.whois.explain.note("more-specific: index build")
+                    index = lglass.whois.indexes.PrefixIndex(
+                        backend,
+                        classes=self.filter_classes(
+                            self.cidr_classes | self.address_classes,
+                            database=backend) | classes)
+                    index.build()
+                    self.prefix_indexes[database.database_name] = index
+                    return index
+        lglass.whois.explain.note("more-specific: prefix index")
+        index.refresh()
+        return index
 
     def query_less_specifics(self, obj, levels=1, database=None):
         database = self._get_database(database)
@@ -411,6 +737,7 @@ class WhoisEngine(object):
             return
         found = 0
         if hasattr(database, "lookup_inetnum"):
+            lglass.whois.explain.note("less-specific: lookup_inetnum index")
             if levels < 0:
                 levels = None
             for class_, key in list(database.lookup_inetnum(obj.ip_network,
@@ -419,6 +746,7 @@ class WhoisEngine(object):
                     continue
                 yield database.fetch(class_, key)
             return
+        lglass.whois.explain.note("less-specific: supernet keys")
         for supernet in obj.ip_network.supernet()[::-1]:
             try:
                 res = database.fetch(obj.type, str(supernet))
@@ -522,9 +850,24 @@ def main(args=None, stdout=sys.stdout, database_cls=lglass.nic.FileDatabase):
                            default=".")
     argparser.add_argument("-q")
     argparser.add_argument("--inverse", "-i")
+    argparser.add_argument("--profile", metavar="DIRECTORY",
+                           help="write profiles of the queries and print "
+                           "the time spent in every stage")
+    argparser.add_argument("--profile-format", default="cprofile",
+                           choices=["cprofile", "stacks"])
+    argparser.add_argument("--debug", action="store_true",
+                           help="print I/O counters of every query")
+    argparser.add_argument("--explain", "-E", action="store_true",
+                           help="print the engine branches and database "
+                           "calls of every query")
 
     args = argparser.parse_args(args=args)
 
+    profiler = None
+    if args.profile is not None:
+        profiler = lglass.whois.profiling.QueryProfiler(
+            args.profile, format=args.profile_format)
+
     db = database_cls(args.database)
     eng = WhoisEngine(db)
     eng.ipv4_more_specific_prefixlens = set(range(0, 33))
@@ -550,30 +893,58 @@ def main(args=None, stdout=sys.stdout, database_cls=lglass.nic.FileDatabase):
         print("% Results for query '{query}'".format(query=term))
         print()
         start_time = time.time()
-        if inverse_fields is not None:
-            results = eng.query_lazy((inverse_fields, (term,)), **query_kwargs)
-        else:
-            results = eng.query_lazy(term, **query_kwargs)
-        for role, obj in results:
-            primary_key = db.primary_key(obj)
-            if role == 'primary':
-                abuse_contact = eng.query_abuse(obj)
-                if abuse_contact:
-                    print("% Abuse contact for '{}' is '{}'".format(
-                        primary_key,
-                        abuse_contact))
+        timer = None
+        database = None
+        if profiler is not None or args.explain:
+            timer = StageTimer()
+        with contextlib.ExitStack() as stack:
+            counters = stack.enter_context(lglass.iostats.scope())
+            if profiler is not None:
+                stack.enter_context(profiler.sample(term))
+            if args.explain:
+                explanation = stack.enter_context(
+                    lglass.whois.explain.scope())
+                database = lglass.proxy.TimingProxyDatabase(
+                    eng.new_query_database(), explanation.record)
+                stack.callback(database.close)
+            if inverse_fields is not None:
+                results = eng.query_lazy((inverse_fields, (term,)),
+                                         timer=timer, database=database,
+                                         **query_kwargs)
+            else:
+                results = eng.query_lazy(term, timer=timer, database=database,
+                                         **query_kwargs)
+            for role, obj in results:
+                primary_key = db.primary_key(obj)
+                if role == 'primary':
+                    abuse_contact = eng.query_abuse(obj, timer=timer,
+                                                    database=database)
+                    if abuse_contact:
+                        print("% Abuse contact for '{}' is '{}'".format(
+                            primary_key,
+                            abuse_contact))
+                        print()
+                if role == 'primary' and args.primary_keys:
+                    obj = obj.primary_key_object()
+                    print("".join(obj.pretty_print(**pretty_print_options)))
+                    continue
+                elif role == 'related' and args.primary_keys:
+                    continue
+                elif role == 'primary':
+                    print("% Information related to '{}'".format(primary_key))
                     print()
-            if role == 'primary' and args.primary_keys:
-                obj = obj.primary_key_object()
                 print("".join(obj.pretty_print(**pretty_print_options)))
-                continue
-            elif role == 'related' and args.primary_keys:
-                continue
-            elif role == 'primary':
-                print("% Information related to '{}'".format(primary_key))
-                print()
-            print("".join(obj.pretty_print(**pretty_print_options)))
-        end_time = time.time()
+            end_time = time.time()
+        if args.debug:
+            print("% I/O: {}".format(lglass.iostats.format_counters(counters)),
+                  file=stdout)
+        if args.explain:
+            for line in explanation.format(counters=counters):
+                print("% Explain: " + line, file=stdout)
+        if profiler is not None or args.explain:
+            for stage, seconds in timer.items():
+                print("% Stage {} took {} seconds for {} objects".format(
+                    stage, seconds, timer.counts[stage]), file=stdout)
         print("% Query took {} seconds".format(end_time - start_time),
               file=stdout)
     print("% All querys took {} seconds".format(
@@ -582,5 +953,4 @@ def main(args=None, stdout=sys.stdout, database_cls=lglass.nic.FileDatabase):
 
 
 if __name__ == "__main__":
-    import cProfile
     main()
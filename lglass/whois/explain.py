@@ -0,0 +1,79 @@
+# coding: utf-8
+
+import collections
+import contextlib
+import contextvars
+
+import lglass.iostats
+
+_explanation = contextvars.ContextVar("lglass_whois_explanation",
+                                      default=None)
+
+
+class Explanation(object):
+    """ Record of the plan of a query: the branches taken by the engine, in
+    the order they were first taken, and the database methods it called,
+    with the number of calls and results and the time spent in them.
+    Branches are noted by the engine in the current explanation, database
+    calls are reported by a lglass.proxy.TimingProxyDatabase with 'record'
+    as callback. """
+
+    def __init__(self):
+        self.branches = collections.Counter()
+        self.calls = {}
+
+    def note(self, branch, n=1):
+        self.branches[branch] += n
+
+    def record(self, method, seconds, results=0):
+        calls, total_results, total_seconds = self.calls.get(method,
+                                                             (0, 0, 0))
+        self.calls[method] = (calls + 1, total_results + results,
+                              total_seconds + seconds)
+
+    def format(self, timer=None, counters=None):
+        """ Return the explanation as list of lines, including the stages
+        of a StageTimer 'timer' and the I/O counters 'counters'. """
+        lines = []
+        for branch, n in self.branches.items():
+            lines.append("branch {} ({}x)".format(branch, n))
+        for method, (calls, results, seconds) in sorted(
+                self.calls.items(), key=lambda i: -i[1][2]):
+            lines.append("call {}: {} calls, {} results, {:.6f} seconds"
+                         .format(method, calls, results, seconds))
+        if timer is not None:
+            for stage, seconds in timer.items():
+                lines.append("stage {}: {} objects, {:.6f} seconds".format(
+                    stage, timer.counts[stage], seconds))
+        if counters:
+            lines.append("I/O: " + lglass.iostats.format_counters(counters))
+        return lines
+
+
+def note(branch):
+    """ Note the branch 'branch' in the current explanation, if there is
+    one. """
+    explanation = _explanation.get()
+    if explanation is not None:
+        explanation.note(branch)
+
+
+def current():
+    return _explanation.get()
+
+
+@contextlib.contextmanager
+def scope(explanation=None):
+    """ Context manager which makes 'explanation', or a new Explanation, the
+    current explanation. Like lglass.iostats.scope, the explanation is
+    inherited by asyncio tasks and copied contexts, but not by threads. """
+    if explanation is None:
+        explanation = Explanation()
+    token = _explanation.set(explanation)
+    try:
+        yield explanation
+    finally:
+        _explanation.reset(token)
+
+
+__all__ = ("Explanation", "note", "current", "scope")
@@ -0,0 +1,224 @@
+# coding: utf-8
+
+import bisect
+import threading
+import time
+
+import netaddr
+
+import lglass.nic
+
+
+class DatabaseIndex(object):
+    """ Base class of indexes over the objects of a database. Indexes are
+    built by build and kept up to date by update and delete, which the
+    database calls for every object saved or deleted through it, if it
+    supports observers. refresh follows the journal of the database, which
+    is checked at most every 'check_interval' seconds, to pick up changes of
+    other processes. Subclasses implement _build, _update and _delete. """
+
+    def __init__(self, database, check_interval=1):
+        self.database = database
+        self.check_interval = check_interval
+        self.built = False
+        self._serial = None
+        self._checked = None
+        self._lock = threading.RLock()
+        if hasattr(database, "add_observer"):
+            database.add_observer(self)
+
+    def build(self):
+        """ Index all objects of the database. """
+        with self._lock:
+            journal = getattr(self.database, "journal", None)
+            serial = None
+            if journal is not None:
+                journal.refresh()
+                serial = journal.last_serial
+            self._build()
+            self.built = True
+            self._serial = serial
+            self._checked = time.monotonic()
+
+    def refresh(self):
+        """ Apply the changes in the journal of the database since the last
+        check, unless it was checked less than 'check_interval' seconds ago.
+        The index is rebuilt if the changes are no longer in the journal.
+        Builds the index if it was not built yet. """
+        if not self.built:
+            with self._lock:
+                if not self.built:
+                    self.build()
+            return
+        journal = getattr(self.database, "journal", None)
+        if journal is None:
+            return
+        now = time.monotonic()
+        if now - self._checked < self.check_interval:
+            return
+        with self._lock:
+            if now - self._checked < self.check_interval:
+                return
+            self._checked = now
+            journal.refresh()
+            if journal.last_serial == self._serial:
+                return
+            if self._serial is None or journal.last_serial < self._serial or \
+                    not journal.complete_since(self._serial):
+                self.build()
+                return
+            for serial, operation, obj in self.database.changes(self._serial):
+                if operation == "DEL":
+                    self._delete(obj)
+                else:
+                    self._update(obj)
+                self._serial = serial
+
+    def update(self, obj):
+        """ Index a saved object. """
+        with self._lock:
+            if self.built:
+                self._update(obj)
+
+    def delete(self, obj):
+        """ Remove a deleted object from the index. """
+        with self._lock:
+            if self.built:
+                self._delete(obj)
+
+    def _spec(self, obj):
+        return (self.database.primary_class(obj.object_class),
+                self.database.primary_key(obj))
+
+    def _build(self):
+        raise NotImplementedError()
+
+    def _update(self, obj):
+        raise NotImplementedError()
+
+    def _delete(self, obj):
+        raise NotImplementedError()
+
+
+class PrefixIndex(DatabaseIndex):
+    """ Index of the address ranges of the objects of 'classes', which are
+    kept in address order, less specific ranges first. The ranges are
+    parsed from the primary keys, hence building the index does not read
+    the objects, unless their keys are no networks or ranges. The list of
+    entries is replaced on every change instead of modified in place, so
+    more_specifics can walk it while other threads update the index. """
+
+    def __init__(self, database, classes=("inetnum", "inet6num"),
+                 check_interval=1):
+        super().__init__(database, check_interval=check_interval)
+        self.classes = frozenset(classes)
+        self._entries = []
+        self._specs = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, object_class, object_key, obj=None):
+        """ Add an object, given by its primary class and key, to the
+        index. """
+        with self._lock:
+            self.remove(object_class, object_key)
+            entry = self._entry(object_class, object_key, obj)
+            if entry is None:
+                return
+            entries = list(self._entries)
+            bisect.insort(entries, entry)
+            self._entries = entries
+            self._specs[(object_class, object_key)] = entry
+
+    def remove(self, object_class, object_key):
+        with self._lock:
+            entry = self._specs.pop((object_class, object_key), None)
+            if entry is not None:
+                entries = list(self._entries)
+                del entries[bisect.bisect_left(entries, entry)]
+                self._entries = entries
+
+    def more_specifics(self, net, classes=None, levels=-1, limit=None):
+        """ Generator of tuples of primary class and key of the objects of
+        'classes', whose ranges are contained in the network or range
+        'net', in address order. Only objects up to 'levels' levels below
+        'net' are returned, or all if 'levels' is negative, and at most
+        'limit' objects. """
+        version, first, last = net.version, net.first, net.last
+        # Changes replace the list, hence this is a consistent snapshot
+        entries = self._entries
+        i = bisect.bisect_left(entries, (version, first))
+        # Last addresses of the enclosing results of the current entry
+        ancestors = []
+        n = 0
+        while i < len(entries):
+            e_version, e_first, e_last, object_class, object_key = entries[i]
+            e_last = -e_last
+            if e_version != version or e_first > last:
+                return
+            i += 1
+            if e_last > last or (e_first == first and e_last == last):
+                continue
+            if classes is not None and object_class not in classes:
+                continue
+            while ancestors and e_first > ancestors[-1]:
+                ancestors.pop()
+            yield (object_class, object_key)
+            n += 1
+            if limit is not None and n >= limit:
+                return
+            if levels >= 0 and len(ancestors) + 1 >= levels:
+                # Skip the more specifics of the entry
+                i = max(i, bisect.bisect_left(entries, (version, e_last + 1)))
+            else:
+                ancestors.append(e_last)
+
+    def _entry(self, object_class, object_key, obj=None):
+        interval = self._interval(object_class, object_key, obj)
+        if interval is None:
+            return None
+        version, first, last = interval
+        return (version, first, -last, object_class, object_key)
+
+    def _interval(self, object_class, object_key, obj=None):
+        try:
+            if "-" in object_key:
+                r = lglass.nic.parse_ip_range(object_key)
+            else:
+                r = netaddr.IPNetwork(object_key)
+            return r.version, r.first, r.last
+        except (netaddr.core.AddrFormatError, ValueError, TypeError):
+            pass
+        if obj is None:
+            try:
+                obj = self.database.fetch(object_class, object_key)
+            except (KeyError, ValueError):
+                return None
+        try:
+            r = obj.ip_range
+        except (AttributeError, netaddr.core.AddrFormatError, ValueError):
+            return None
+        return r.version, r.first, r.last
+
+    def _build(self):
+        entries = []
+        for object_class, object_key in self.database.lookup(
+                classes=self.classes):
+            entry = self._entry(object_class, object_key)
+            if entry is not None:
+                entries.append(entry)
+        entries.sort()
+        self._specs = {(entry[3], entry[4]): entry for entry in entries}
+        self._entries = entries
+
+    def _update(self, obj):
+        spec = self._spec(obj)
+        if spec[0] in self.classes:
+            self.add(*spec, obj=obj)
+
+    def _delete(self, obj):
+        self.remove(*self._spec(obj))
+
+
+__all__ = ("DatabaseIndex", "PrefixIndex")
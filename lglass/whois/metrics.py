@@ -0,0 +1,194 @@
+# coding: utf-8
+
+import asyncio
+import bisect
+import threading
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\")
+                         .replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    """ Base class of metrics, which have a name, a help text and a tuple
+    of label names. The value of a metric may be computed by 'function'
+    when the metric is rendered, which returns either a value or a
+    dictionary of tuples of label values and values. """
+
+    type = "untyped"
+
+    def __init__(self, name, help, labels=(), function=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.function = function
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labels)
+
+    def samples(self):
+        """ Return list of tuples of name suffix, label names, label values,
+        additional labels and value. """
+        if self.function is not None:
+            value = self.function()
+            if isinstance(value, dict):
+                return [("", self.labels, key, (), value)
+                        for key, value in sorted(value.items())]
+            return [("", (), (), (), value)]
+        return [("", self.labels, key, (), value)
+                for key, value in sorted(self._values.items())]
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help),
+                 "# TYPE {} {}".format(self.name, self.type)]
+        for suffix, names, values, extra, value in self.samples():
+            lines.append("{}{}{} {}".format(
+                self.name, suffix, _format_labels(names, values, extra),
+                _format_value(value)))
+        return "\n".join(lines) + "\n"
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Histogram(Metric):
+    type = "histogram"
+    default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                       0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, help, labels=(), buckets=None):
+        super().__init__(name, help, labels)
+        if buckets is None:
+            buckets = self.default_buckets
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            try:
+                counts, total = self._values[key]
+            except KeyError:
+                counts, total = [0] * (len(self.buckets) + 1), 0
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def samples(self):
+        samples = []
+        for key, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                samples.append(("_bucket", self.labels, key,
+                                (("le", _format_value(bound)),), cumulative))
+            samples.append(("_sum", self.labels, key, (), total))
+            samples.append(("_count", self.labels, key, (), cumulative))
+        return samples
+
+
+class Registry(object):
+    """ Collection of metrics, which are rendered in the Prometheus text
+    exposition format. """
+
+    def __init__(self, prefix=""):
+        self.prefix = prefix
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=(), function=None):
+        return self.register(Counter(self.prefix + name, help, labels,
+                                     function=function))
+
+    def gauge(self, name, help, labels=(), function=None):
+        return self.register(Gauge(self.prefix + name, help, labels,
+                                   function=function))
+
+    def histogram(self, name, help, labels=(), buckets=None):
+        return self.register(Histogram(self.prefix + name, help, labels,
+                                       buckets=buckets))
+
+    def render(self):
+        return "".join(metric.render() for metric in self._metrics)
+
+
+async def handle_http(registry, reader, writer):
+    """ Answers a HTTP request with the rendered metrics of the registry,
+    regardless of its path. """
+    try:
+        request = await asyncio.wait_for(reader.readline(), 10)
+        while True:
+            line = await asyncio.wait_for(reader.readline(), 10)
+            if line in (b"\r\n", b"\n", b""):
+                break
+    except (asyncio.TimeoutError, ValueError):
+        writer.close()
+        return
+    body = registry.render().encode()
+    if request.startswith(b"GET "):
+        status = b"200 OK"
+    else:
+        status, body = b"405 Method Not Allowed", b""
+    writer.write(b"HTTP/1.0 " + status + b"\r\n"
+                 b"Content-Type: text/plain; version=0.0.4\r\n"
+                 b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+                 b"Connection: close\r\n\r\n" + body)
+    try:
+        await writer.drain()
+    except ConnectionError:
+        pass
+    writer.close()
+
+
+def start_http_server(registry, address, port, **kwargs):
+    """ Return coroutine which starts a HTTP listener for the metrics of
+    the registry. """
+    return asyncio.start_server(
+        lambda reader, writer: handle_http(registry, reader, writer),
+        address, port, **kwargs)
+
+
+__all__ = ("Metric", "Counter", "Gauge", "Histogram", "Registry",
+           "start_http_server")
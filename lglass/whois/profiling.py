@@ -0,0 +1,113 @@
+# coding: utf-8
+
+import cProfile
+import collections
+import itertools
+import os
+import re
+import sys
+import threading
+
+
+class StackSampler(object):
+    """ Samples the stack of a thread every 'interval' seconds from a
+    background thread and counts the collapsed stacks, as consumed by
+    flamegraph.pl and compatible tools. """
+
+    def __init__(self, thread_id=None, interval=0.001):
+        if thread_id is None:
+            thread_id = threading.get_ident()
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("{} ({}:{})".format(
+                    code.co_name, os.path.basename(code.co_filename),
+                    code.co_firstlineno))
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+
+    def write(self, fh):
+        for stack, count in sorted(self.stacks.items()):
+            fh.write("{} {}\n".format(stack, count))
+
+
+class _Sample(object):
+    def __init__(self, profiler, path):
+        self.profiler = profiler
+        self.path = path
+        self._profile = None
+
+    def __enter__(self):
+        if self.profiler.format == "stacks":
+            self._profile = StackSampler(interval=self.profiler.interval)
+            self._profile.start()
+        else:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.profiler.format == "stacks":
+            self._profile.stop()
+            with open(self.path, "w") as fh:
+                self._profile.write(fh)
+        else:
+            self._profile.disable()
+            self._profile.dump_stats(self.path)
+
+
+class QueryProfiler(object):
+    """ Profiles every 'sample_every'-th query, either with cProfile
+    ('cprofile' format) or by sampling the stack ('stacks' format, the
+    collapsed stacks of flamegraph.pl). The profile of every sampled query
+    is written to a file in 'directory', named by a sequence number and the
+    query. Profiles are taken in the thread which enters the sample. """
+
+    formats = ("cprofile", "stacks")
+
+    def __init__(self, directory, format="cprofile", sample_every=1,
+                 interval=0.001):
+        if format not in self.formats:
+            raise ValueError("Unknown profile format {!r}".format(format))
+        self.directory = directory
+        self.format = format
+        self.sample_every = sample_every
+        self.interval = interval
+        self._counter = itertools.count()
+        os.makedirs(directory, exist_ok=True)
+
+    def sample(self, name):
+        """ Return a context manager which profiles the query 'name', or
+        None if the query is not sampled. """
+        n = next(self._counter)
+        if n % self.sample_every:
+            return None
+        name = re.sub(r"[^A-Za-z0-9.:-]+", "_", str(name))[:64]
+        extension = ".stacks" if self.format == "stacks" else ".prof"
+        return _Sample(self, os.path.join(
+            self.directory, "{:08d}-{}{}".format(n, name, extension)))
+
+
+__all__ = ("StackSampler", "QueryProfiler")
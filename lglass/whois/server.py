@@ -1,8 +1,29 @@
 import argparse
 import asyncio
+import collections
+import concurrent.futures
+import contextvars
+import functools
+import itertools
+import os
+import re
+import signal
+import sys
+import threading
+import time
+import traceback
+
+import netaddr
 
 import lglass
+import lglass.iostats
+import lglass.proxy
+import lglass.whois.abuse
 import lglass.whois.engine
+import lglass.whois.explain
+import lglass.whois.indexes
+import lglass.whois.metrics
+import lglass.whois.profiling
 import lglass.nic
 
 
@@ -14,6 +35,106 @@ class SolidArgumentParser(argparse.ArgumentParser):
         pass
 
 
+class QueryParser(object):
+    """ Fast parser for whois request lines, which is compiled once from the
+    actions of an argparse.ArgumentParser and produces the same namespace
+    for the usual flags: single-dash short options, which may be combined
+    and carry attached values, long options, unambiguous prefixes of long
+    options and '--'. Unknown options are ignored, like SolidArgumentParser
+    does. Results are cached by request line in a LRU cache, hence the
+    returned namespaces must not be modified. Returns None if the request
+    line is invalid. """
+
+    _negative_number = re.compile(r"^-\d+$|^-\d*\.\d+$")
+
+    def __init__(self, argparser, cache_size=4096):
+        self._options = {}
+        self._defaults = {}
+        self._positional = None
+        for action in argparser._actions:
+            if not action.option_strings:
+                self._positional = action.dest
+            else:
+                for option_string in action.option_strings:
+                    self._options[option_string] = action
+            self._defaults.setdefault(action.dest, action.default)
+        self._long_options = sorted(opt for opt in self._options
+                                    if opt.startswith("--"))
+        self.parse = functools.lru_cache(maxsize=cache_size)(self._parse)
+
+    def flags(self, namespace):
+        """ Return list of the destinations of all options which differ
+        from their default in a parsed namespace. """
+        return [dest for dest, value in vars(namespace).items()
+                if dest != self._positional and
+                value != self._defaults.get(dest)]
+
+    def _long_option(self, option):
+        try:
+            return self._options[option]
+        except KeyError:
+            pass
+        candidates = [opt for opt in self._long_options
+                      if opt.startswith(option)]
+        if len(candidates) == 1:
+            return self._options[candidates[0]]
+
+    def _parse(self, request):
+        values = dict(self._defaults)
+        positionals = []
+        tokens = iter(request.split())
+        for token in tokens:
+            if token == "--":
+                positionals.extend(tokens)
+                break
+            elif token[0] != "-" or token == "-" or \
+                    self._negative_number.match(token):
+                positionals.append(token)
+                continue
+            if token.startswith("--"):
+                option, sep, value = token.partition("=")
+                action = self._long_option(option)
+                if action is None:
+                    continue
+                if action.nargs == 0:
+                    if sep:
+                        return None
+                    values[action.dest] = action.const
+                    continue
+                if not sep:
+                    value = next(tokens, None)
+                    if value is None:
+                        return None
+                if action.choices is not None and \
+                        value not in action.choices:
+                    return None
+                values[action.dest] = value
+                continue
+            # Combined short options
+            for i in range(1, len(token)):
+                action = self._options.get("-" + token[i])
+                if action is None:
+                    continue
+                if action.nargs == 0:
+                    values[action.dest] = action.const
+                    continue
+                value = token[i + 1:]
+                if value.startswith("="):
+                    value = value[1:]
+                if not value:
+                    value = next(tokens, None)
+                    if value is None:
+                        return None
+                if action.choices is not None and \
+                        value not in action.choices:
+                    return None
+                values[action.dest] = value
+                break
+        if self._positional is not None:
+            values[self._positional] = positionals
+        return argparse.Namespace(**values)
+
+
 class AsyncIteratorWrapper(object):
     def __init__(self, iterable, loop=None, executor=None):
         if loop is None:
@@ -35,6 +156,313 @@ class AsyncIteratorWrapper(object):
             self._executor, _next, self._iterable)
 
 
+class ResponseCache(object):
+    """ LRU cache of encoded query responses. Every entry expires 'ttl'
+    seconds after it was stored and is dropped when the state of one of the
+    queried databases, as returned by their state method or their serial,
+    differs from the state at the time of storing. Database states are
+    checked at most every 'check_interval' seconds. """
+
+    def __init__(self, ttl=60, max_entries=1024, max_size=1 << 20,
+                 check_interval=1):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.check_interval = check_interval
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._states = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def state(self, databases):
+        """ Return tuple of the states of the given databases. """
+        now = time.monotonic()
+        states = []
+        for database in databases:
+            try:
+                checked, state = self._states[id(database)]
+            except KeyError:
+                checked, state = None, None
+            if checked is None or now - checked >= self.check_interval:
+                if hasattr(database, "state"):
+                    state = database.state()
+                else:
+                    state = getattr(database, "serial", None)
+                self._states[id(database)] = (now, state)
+            states.append(state)
+        return tuple(states)
+
+    def get(self, key, state):
+        try:
+            expires, entry_state, payload = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        if expires < time.monotonic() or entry_state != state:
+            del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return payload
+
+    def put(self, key, state, payload):
+        if len(payload) > self.max_size:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, state, payload)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+        self._states.clear()
+
+
+class TokenBucket(object):
+    """ Token bucket which holds up to 'burst' tokens and is refilled by
+    'rate' tokens per second. """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def reserve(self, tokens, max_delay=0):
+        """ Takes tokens from the bucket, if they are available within
+        'max_delay' seconds, and returns the number of seconds to wait
+        until they are. Otherwise returns None and takes nothing. """
+        now = time.monotonic()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        delay = max(0, (tokens - self.tokens) / self.rate)
+        if delay > max_delay:
+            return None
+        self.tokens -= tokens
+        return delay
+
+
+class AdmissionControl(object):
+    """ Limits the queries of every client network by a token bucket, from
+    which each query takes its estimated cost, and the number of queries
+    which run at the same time. Without 'rate', only the number of
+    concurrent queries is limited. Clients are grouped by networks of
+    'ipv4_prefix_length' and 'ipv6_prefix_length'. Queries are delayed by
+    up to 'max_delay' seconds until their client has enough tokens, and
+    wait up to 'queue_timeout' seconds for one of 'max_concurrent' slots,
+    otherwise they are rejected. """
+
+    def __init__(self, rate=5, burst=50, max_concurrent=None,
+                 ipv4_prefix_length=32, ipv6_prefix_length=64, max_delay=1,
+                 queue_timeout=5, max_clients=65536):
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrent = max_concurrent
+        self.ipv4_prefix_length = ipv4_prefix_length
+        self.ipv6_prefix_length = ipv6_prefix_length
+        self.max_delay = max_delay
+        self.queue_timeout = queue_timeout
+        self.max_clients = max_clients
+        self.rejected = 0
+        self._buckets = collections.OrderedDict()
+        # Created by acquire, since semaphores are bound to the event loop
+        # on Python before 3.10
+        self._slots = None
+
+    def client_network(self, address):
+        """ Return the network of a client address, which shares a bucket
+        with the other clients in it. """
+        if address is None:
+            return None
+        try:
+            address = netaddr.IPAddress(address)
+        except (netaddr.AddrFormatError, ValueError):
+            return address
+        if address.is_ipv4_mapped():
+            address = address.ipv4()
+        if address.version == 4:
+            prefix_length = self.ipv4_prefix_length
+        else:
+            prefix_length = self.ipv6_prefix_length
+        return netaddr.IPNetwork((int(address), prefix_length),
+                                 version=address.version).cidr
+
+    def bucket(self, address):
+        network = self.client_network(address)
+        try:
+            self._buckets.move_to_end(network)
+            return self._buckets[network]
+        except KeyError:
+            pass
+        bucket = self._buckets[network] = TokenBucket(self.rate, self.burst)
+        while len(self._buckets) > self.max_clients:
+            self._buckets.popitem(last=False)
+        return bucket
+
+    async def acquire(self, address, cost=1):
+        """ Waits until a query of the client with the given cost may run.
+        Returns False if the query is rejected. Every admitted query must
+        be followed by a call to release. """
+        if self.rate is not None:
+            delay = self.bucket(address).reserve(cost, self.max_delay)
+            if delay is None:
+                self.rejected += 1
+                return False
+            if delay:
+                await asyncio.sleep(delay)
+        if self.max_concurrent:
+            if self._slots is None:
+                self._slots = asyncio.Semaphore(self.max_concurrent)
+            try:
+                await asyncio.wait_for(self._slots.acquire(),
+                                       self.queue_timeout)
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                return False
+        return True
+
+    def release(self):
+        if self._slots is not None:
+            self._slots.release()
+
+
+class ExecutorLane(object):
+    """ Bounded thread pool for a class of queries. At most 'workers'
+    queries of the lane run at the same time, and at most 'max_queued'
+    further queries wait for their turn. Other queries are rejected. """
+
+    def __init__(self, workers, max_queued=None):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self.queued = 0
+        # Created by acquire, like the slots of AdmissionControl
+        self._slots = None
+
+    async def acquire(self):
+        """ Waits for a free slot in the lane. Returns False if the queue of
+        the lane is full. Every successful call must be followed by a call
+        to release. """
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers)
+        if self._slots.locked() and self.max_queued is not None and \
+                self.queued >= self.max_queued:
+            return False
+        self.queued += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.queued -= 1
+        return True
+
+    def release(self):
+        self._slots.release()
+
+
+class RecordingWriter(object):
+    """ Wrapper for a stream writer, which passes all data through and keeps
+    a copy of it until more than 'limit' bytes were written. """
+
+    def __init__(self, writer, limit=None):
+        self._writer = writer
+        self._limit = limit
+        self._chunks = []
+        self._size = 0
+        self.recording = True
+
+    def write(self, data):
+        self._writer.write(data)
+        if self.recording:
+            self._size += len(data)
+            if self._limit is not None and self._size > self._limit:
+                self.recording = False
+                self._chunks = []
+            else:
+                self._chunks.append(bytes(data))
+
+    async def drain(self):
+        await self._writer.drain()
+
+    def getvalue(self):
+        return b"".join(self._chunks)
+
+    def stop_recording(self):
+        """ Discards the copy of the data, for responses which must not be
+        cached. """
+        self.recording = False
+        self._chunks = []
+
+    def __getattr__(self, name):
+        return getattr(self._writer, name)
+
+
+class DrainTimeoutWriter(object):
+    """ Wrapper for a stream writer, which aborts the connection when the
+    client doesn't read its data within 'timeout' seconds. """
+
+    def __init__(self, writer, timeout):
+        self._writer = writer
+        self._timeout = timeout
+
+    def write(self, data):
+        self._writer.write(data)
+
+    async def drain(self):
+        try:
+            await asyncio.wait_for(self._writer.drain(), self._timeout)
+        except asyncio.TimeoutError:
+            self._writer.transport.abort()
+            raise ConnectionResetError("Client did not read response")
+
+    def __getattr__(self, name):
+        return getattr(self._writer, name)
+
+
+class BufferWriter(object):
+    """ Stand-in for a stream writer of a response which is not due yet.
+    The data is collected in memory until release is called, which writes
+    it to 'writer' and passes further data through. Once more than 'limit'
+    bytes are collected, drain waits for the release, which pauses the
+    producer of the response. Other attributes are taken from 'writer'. """
+
+    def __init__(self, writer, limit=None):
+        self._writer = writer
+        self._limit = limit
+        self._chunks = []
+        self._size = 0
+        self._released = asyncio.Event()
+
+    def write(self, data):
+        if self._released.is_set():
+            self._writer.write(data)
+        else:
+            self._chunks.append(bytes(data))
+            self._size += len(data)
+
+    async def drain(self):
+        if not self._released.is_set():
+            if self._limit is None or self._size <= self._limit:
+                return
+            await self._released.wait()
+        await self._writer.drain()
+
+    def release(self):
+        """ Writes the collected data to the writer and passes further data
+        through. """
+        self._writer.write(b"".join(self._chunks))
+        self._chunks = []
+        self._size = 0
+        self._released.set()
+
+    def __getattr__(self, name):
+        return getattr(self._writer, name)
+
+
 class Base(object):
     def __init__(self, engine, databases):
         self.databases = list(databases)
@@ -59,15 +487,102 @@ class SimpleWhoisServer(Base):
     preamble_template = "% This is the {source} Database query service.\n" + \
         "% The objects are in RPSL format.\n\n"
     abuse_template = "% Abuse contact for '{object_key}' is '{contact}'\n"
+    mirror_syntax_template = "%ERROR:405: syntax error\n\n"
+    mirror_source_template = "%ERROR:403: unknown source {source}\n\n"
+    mirror_version_template = "%ERROR:406: unsupported protocol version\n\n"
+    mirror_range_template = "%ERROR:401: invalid range: Not within " + \
+        "{first}-{last}\n\n"
+    source_timeout_template = "% Query of source {source} timed out\n\n"
+    query_timeout_template = "%ERROR:305: query timed out\n\n"
+    idle_timeout_template = "%ERROR:305: connection has been closed\n\n"
+    line_too_long_template = "%ERROR:107: input line too long\n\n"
+    connection_limit_template = "%ERROR:208: too many connections\n\n"
     allow_inverse_search = True
+    allow_mirroring = True
+    concurrent_sources = False
+    pipeline_depth = 1
+    response_buffer_size = 65536
+    inverse_query_cost = 10
+    more_specific_query_cost = 10
+    source_timeout = None
+    query_deadline = None
+    idle_timeout = None
+    max_request_length = 1024
+    max_connections = None
+    write_buffer_high = None
+    write_buffer_low = None
+    write_timeout = None
+    connections = 0
+    profiler = None
+    debug = False
+    mirror_poll_interval = 5
+    result_chunk_size = 16384
+    result_queue_size = 8
+    query_parser_cache_size = 4096
+    _uncached_flags = frozenset(["persistent_connection", "terms", "a",
+                                 "sources"])
+    _query_parser = None
 
-    def __init__(self, engine, databases, default_sources=None, executor=None):
+    def __init__(self, engine, databases, default_sources=None, executor=None,
+                 response_cache=None, admission_control=None, lanes=None,
+                 metrics=None):
         self.databases = list(databases)
         if default_sources is None:
             default_sources = [self.primary_database.database_name]
         self.default_sources = default_sources
         self.engine = engine
         self.executor = executor
+        self.response_cache = response_cache
+        self.admission_control = admission_control
+        if lanes is None:
+            lanes = {}
+        self.lanes = lanes
+        if metrics is None:
+            metrics = lglass.whois.metrics.Registry(prefix="lglass_whois_")
+        self.metrics = metrics
+        self._init_metrics()
+
+    def _init_metrics(self):
+        m = self.metrics
+        self._queries_metric = m.counter(
+            "queries_total", "Number of queries by type", ("type",))
+        self._flags_metric = m.counter(
+            "query_flags_total", "Number of queries by flag", ("flag",))
+        self._errors_metric = m.counter(
+            "query_errors_total", "Number of failed queries by reason",
+            ("reason",))
+        self._stage_metric = m.histogram(
+            "query_stage_seconds", "Time spent in the stages of queries",
+            ("stage",))
+        self._engine_stage_metric = m.histogram(
+            "engine_stage_seconds", "Time spent in the stages of the "
+            "whois engine per query", ("stage",))
+        self._io_metric = m.counter(
+            "io_operations_total", "Number of I/O operations of the "
+            "databases by operation", ("operation",))
+        self._objects_metric = m.counter(
+            "objects_returned_total", "Number of objects returned")
+        self._tasks_metric = m.gauge(
+            "executor_tasks", "Number of result producers in the executors",
+            ("state",))
+        m.gauge("open_connections", "Number of open connections",
+                function=lambda: self.connections)
+        m.gauge("lane_queued", "Number of queries waiting for a lane",
+                ("lane",), function=lambda: {
+                    (name,): lane.queued for name, lane in self.lanes.items()})
+        if self.response_cache is not None:
+            cache = self.response_cache
+            m.counter("response_cache_hits_total", "Response cache hits",
+                      function=lambda: cache.hits)
+            m.counter("response_cache_misses_total", "Response cache misses",
+                      function=lambda: cache.misses)
+            m.gauge("response_cache_entries", "Cached responses",
+                    function=lambda: len(cache))
+        if self.admission_control is not None:
+            admission_control = self.admission_control
+            m.counter("admission_rejected_total",
+                      "Queries rejected by admission control",
+                      function=lambda: admission_control.rejected)
 
     @property
     def preamble(self):
@@ -116,15 +631,44 @@ class SimpleWhoisServer(Base):
                                help="display this help")
         argparser.add_argument("--client-address", action="store_true",
                                help="perform query for client ip address")
+        argparser.add_argument("-g", dest="mirror",
+                               help="request NRTM stream for "
+                               "SOURCE:3:FIRST-LAST")
+        argparser.add_argument("--explain", "-E", action="store_true",
+                               help="explain the query plan, database calls "
+                               "and I/O of the query")
         return argparser
 
+    def parse_request(self, request):
+        """ Parses a request line into a namespace of query arguments, or
+        returns None for invalid requests. """
+        if self._query_parser is None:
+            self._query_parser = QueryParser(
+                self._build_argparser(),
+                cache_size=self.query_parser_cache_size)
+        return self._query_parser.parse(request)
+
+    def cache_key(self, args, databases, terms):
+        """ Returns the key of the response to a query in the response
+        cache. Flags which don't change the response are ignored. """
+        flags = tuple(sorted(
+            (key, tuple(value) if isinstance(value, list) else value)
+            for key, value in vars(args).items()
+            if key not in self._uncached_flags))
+        return (flags, tuple(db.database_name for db in databases),
+                tuple(terms))
+
     async def query(self, request, writer):
-        argparser = self._build_argparser()
-        try:
-            args = argparser.parse_args(request.split())
-        except:
+        started = time.perf_counter()
+        args = self.parse_request(request)
+        self._stage_metric.observe(time.perf_counter() - started,
+                                   stage="parse")
+        self._queries_metric.inc(type=self.query_type(args))
+        if args is None:
             await writer.drain()
             return False
+        for flag in self._query_parser.flags(args):
+            self._flags_metric.inc(flag=flag)
 
         primary_database = self.primary_database
         if args.a:
@@ -140,7 +684,12 @@ class SimpleWhoisServer(Base):
             if args.sources:
                 primary_database = databases[0]
 
-        if args.q:
+        if args.mirror:
+            await self.mirror(args.mirror, writer,
+                              keepalive=args.persistent_connection)
+            await writer.drain()
+            return False
+        elif args.q:
             if args.q == "version":
                 writer.write(self.version_string)
             elif args.q == "types":
@@ -149,8 +698,9 @@ class SimpleWhoisServer(Base):
                         sorted(primary_database.object_classes)).encode())
                 writer.write(b"\n\n")
             elif args.q == "sources":
-                for source in self.sources:
-                    writer.write(source.encode() + b":3:N:0-0\n")
+                for database in self.databases:
+                    writer.write(self.source_status(database).encode() +
+                                 b"\n")
                 writer.write(b"\n")
             await writer.drain()
             return args.persistent_connection
@@ -159,17 +709,121 @@ class SimpleWhoisServer(Base):
         elif args.help:
             writer.write(
                 self.format_comment(
-                    argparser.format_help()).encode() +
+                    self._build_argparser().format_help()).encode() +
                 b"\n")
             await writer.drain()
             return args.persistent_connection
 
         if args.client_address:
             terms = [writer.get_extra_info('peername')[0]]
-            writer.write(
-                "% Your client IP address is {}\n\n".format(terms[0]).encode())
         else:
             terms = args.terms
+
+        cache_key = None
+        # Explanations and debug output contain timings and are never cached
+        if self.response_cache is not None and not args.explain and \
+                not self.debug:
+            stage_started = time.perf_counter()
+            cache_key = self.cache_key(args, databases, terms)
+            cache_state = self.response_cache.state(databases)
+            payload = self.response_cache.get(cache_key, cache_state)
+            self._stage_metric.observe(time.perf_counter() - stage_started,
+                                       stage="cache")
+            if payload is not None:
+                writer.write(payload)
+                await writer.drain()
+                self._stage_metric.observe(time.perf_counter() - started,
+                                           stage="total")
+                return args.persistent_connection
+            writer = RecordingWriter(writer, self.response_cache.max_size)
+
+        stage_started = time.perf_counter()
+        if self.admission_control is not None:
+            peer = writer.get_extra_info('peername')
+            if not await self.admission_control.acquire(
+                    peer[0] if peer else None,
+                    self.query_cost(args, databases)):
+                self._errors_metric.inc(reason="rate-limit")
+                writer.write(self.not_allowed_message.encode())
+                await writer.drain()
+                return False
+        lane = self.lanes.get(self.query_lane(args))
+        if lane is not None and not await lane.acquire():
+            if self.admission_control is not None:
+                self.admission_control.release()
+            self._errors_metric.inc(reason="lane-full")
+            writer.write(self.not_allowed_message.encode())
+            await writer.drain()
+            return False
+        self._stage_metric.observe(time.perf_counter() - stage_started,
+                                   stage="admission")
+        stage_started = time.perf_counter()
+        try:
+            await asyncio.wait_for(
+                self.answer_query(args, databases, terms, writer),
+                self.query_deadline)
+        except asyncio.TimeoutError:
+            self._errors_metric.inc(reason="deadline")
+            writer.write(self.query_timeout_template.encode())
+            await writer.drain()
+            return False
+        finally:
+            if lane is not None:
+                lane.release()
+            if self.admission_control is not None:
+                self.admission_control.release()
+        self._stage_metric.observe(time.perf_counter() - stage_started,
+                                   stage="query")
+
+        if cache_key is not None and writer.recording:
+            self.response_cache.put(cache_key, cache_state, writer.getvalue())
+
+        self._stage_metric.observe(time.perf_counter() - started,
+                                   stage="total")
+        return args.persistent_connection
+
+    def query_cost(self, args, databases):
+        """ Estimates the cost of a query before it is executed. """
+        cost = 1
+        if args.inverse:
+            cost += self.inverse_query_cost
+        if args.more_specific_levels:
+            cost += self.more_specific_query_cost
+        if args.less_specific_levels:
+            cost += 1
+        return cost * len(databases)
+
+    def query_type(self, args):
+        """ Classifies a parsed query for the query metrics. """
+        if args is None:
+            return "invalid"
+        elif args.mirror:
+            return "mirror"
+        elif args.q:
+            return "info"
+        elif args.template is not None or args.help:
+            return "help"
+        elif args.inverse:
+            return "inverse"
+        elif args.more_specific_levels:
+            return "more-specific"
+        elif args.less_specific_levels:
+            return "less-specific"
+        return "lookup"
+
+    def query_lane(self, args):
+        """ Classifies a query as 'heavy', if it is an inverse query, asks
+        for more specifics or spans several sources, or as 'light'. """
+        if args.inverse or args.more_specific_levels or args.a or \
+                (args.sources and "," in args.sources):
+            return "heavy"
+        return "light"
+
+    async def answer_query(self, args, databases, terms, writer):
+        """ Queries the databases and writes the response. """
+        if args.client_address:
+            writer.write(
+                "% Your client IP address is {}\n\n".format(terms[0]).encode())
         if args.inverse:
             inverse_fields = args.inverse.split(",")
             terms = [(inverse_fields, (term.replace("_", " "),))
@@ -177,70 +831,170 @@ class SimpleWhoisServer(Base):
 
         query_kwargs = lglass.whois.engine.args_to_query_kwargs(args)
         found_any = False
+        started = time.perf_counter()
 
-        for database in databases:
-            results = await self.perform_query(database, terms, args,
-                                               query_kwargs, writer)
-            if results:
-                found_any = True
-                if not args.inverse:
-                    break
+        # The counters are shared with the tasks of concurrent sources
+        with lglass.iostats.scope() as counters:
+            if self.concurrent_sources and len(databases) > 1:
+                found_any = await self.perform_queries(
+                    databases, terms, args, query_kwargs, writer)
+            else:
+                for database in databases:
+                    results = await self.query_source(
+                        database, terms, args, query_kwargs, writer)
+                    if results:
+                        found_any = True
+                        if not args.inverse:
+                            break
 
         if not found_any:
             writer.write(self.not_found_message(databases).encode())
 
+        for operation, n in counters.items():
+            self._io_metric.inc(n, operation=operation)
+        if self.debug:
+            writer.write(self.format_comment(
+                "Query took {} seconds\nI/O: {}".format(
+                    time.perf_counter() - started,
+                    lglass.iostats.format_counters(counters))).encode())
+
         writer.write(b"\n")
         await writer.drain()
 
-        return args.persistent_connection
+    def format_result(self, role, obj, primary_keys=False,
+                      include_abuse_contact=True, pretty_print_options={},
+                      database=None, timer=None):
+        """ Formats a single result of a query, given by its role and object,
+        according to 'pretty_print_options'. Determines the abuse contact of
+        primary objects, if required, and deduces the canonical primary key
+        of the object. This method is blocking and returns a string. """
+        res = []
+        primary_key = database.primary_key(obj)
+        if role == 'primary' and include_abuse_contact:
+            abuse_contact = self.engine.query_abuse(obj, database=database,
+                                                    timer=timer)
+            if abuse_contact:
+                res.append(self.abuse_message(primary_key, abuse_contact))
+                res.append("\n")
+        if role == 'primary' and primary_keys:
+            res.extend(obj.primary_key_object().pretty_print(
+                **pretty_print_options))
+            res.append("\n")
+            return "".join(res)
+        elif role == 'related' and primary_keys:
+            return ""
+        elif role == 'primary':
+            res.append("% Information related to '{}'\n\n".format(
+                primary_key))
+        res.extend(obj.pretty_print(**pretty_print_options))
+        res.append("\n")
+        return "".join(res)
 
     async def send_results(self, writer, results, primary_keys=False,
                            include_abuse_contact=True, pretty_print_options={},
-                           database=None):
-        """ This coroutine takes objects from an asynchronous iterator, called
-        'results', and writes them to the writer, called 'writer'. It performs
-        the formatting steps according to 'pretty_print_options', determines
-        the abuse contact, if required, and deduces the canonical primary keys
-        of the returned objects. """
+                           database=None, executor=None, cancelled=None,
+                           timer=None, profile=None):
+        """ This coroutine takes tuples of role and object from the blocking
+        iterator 'results' and writes them to the writer, called 'writer'.
+        The iteration, including abuse contact lookups and formatting, runs
+        as a single task in the executor, which hands the output to the event
+        loop in chunks of about 'result_chunk_size' bytes through a queue of
+        at most 'result_queue_size' chunks. Returns the number of results.
+        The task runs in 'executor', or in the executor of the server. The
+        event 'cancelled' is set when the writer fails or the coroutine is
+        cancelled. The task is profiled within the context manager
+        'profile', if given, and runs in a copy of the current context, so
+        it counts its I/O operations in the current scope. """
 
         loop = asyncio.get_running_loop()
-        n = 0
-        async for role, obj in results:
-            n += 1
-            primary_key = database.primary_key(obj)
-            if role == 'primary' and include_abuse_contact:
-                # query_abuse is potentially blocking, hence we are calling it
-                # through loop.run_in_executor()
-                abuse_contact = await loop.run_in_executor(
-                    self.executor,
-                    lambda: self.engine.query_abuse(obj, database=database))
-                if abuse_contact:
-                    writer.write(self.abuse_message(primary_key,
-                                                    abuse_contact).encode())
-                    writer.write(b"\n")
-            if role == 'primary' and primary_keys:
-                writer.write("".join(obj.primary_key_object().pretty_print(
-                    **pretty_print_options)).encode())
-                writer.write(b"\n")
-                continue
-            elif role == 'related' and primary_keys:
-                continue
-            elif role == 'primary':
-                writer.write("% Information related to '{}'\n\n".format(
-                    primary_key).encode())
+        queue = asyncio.Queue(self.result_queue_size)
+        if cancelled is None:
+            cancelled = threading.Event()
 
-            writer.write(
-                "".join(
-                    obj.pretty_print(
-                        **pretty_print_options)).encode())
-            writer.write(b"\n")
-        return n
+        def _put(chunk):
+            if not cancelled.is_set():
+                asyncio.run_coroutine_threadsafe(queue.put(chunk),
+                                                 loop).result()
+
+        def _produce():
+            self._tasks_metric.dec(state="pending")
+            self._tasks_metric.inc(state="running")
+            n = 0
+            chunk = []
+            size = 0
+            profiling = False
+            try:
+                try:
+                    if profile is not None:
+                        # Profiling is optional, hence its failures are only
+                        # reported
+                        try:
+                            profile.__enter__()
+                            profiling = True
+                        except Exception:
+                            traceback.print_exc()
+                    for role, obj in results:
+                        if cancelled.is_set():
+                            break
+                        n += 1
+                        res = self.format_result(
+                            role, obj, primary_keys=primary_keys,
+                            include_abuse_contact=include_abuse_contact,
+                            pretty_print_options=pretty_print_options,
+                            database=database, timer=timer).encode()
+                        chunk.append(res)
+                        size += len(res)
+                        if size >= self.result_chunk_size:
+                            _put(b"".join(chunk))
+                            chunk = []
+                            size = 0
+                    if chunk:
+                        _put(b"".join(chunk))
+                finally:
+                    if profiling:
+                        try:
+                            profile.__exit__(None, None, None)
+                        except Exception:
+                            traceback.print_exc()
+                    self._tasks_metric.dec(state="running")
+            finally:
+                _put(None)
+            return n
+
+        if executor is None:
+            executor = self.executor
+        self._tasks_metric.inc(state="pending")
+        producer = loop.run_in_executor(
+            executor, contextvars.copy_context().run, _produce)
+        try:
+            while True:
+                chunk = await queue.get()
+                if chunk is None:
+                    break
+                writer.write(chunk)
+                await writer.drain()
+        finally:
+            # Unblock the producer, if we stopped early
+            cancelled.set()
+            while not queue.empty():
+                queue.get_nowait()
+        return await producer
 
     async def perform_query(self, database, terms, query_args, query_kwargs,
                             writer):
         """ Performs a query, given by its search terms and query options,
         asynchronously on a database and writes the response to a writer. """
+        lane = self.lanes.get(self.query_lane(query_args))
+        database_name = database.database_name
         database = self.engine.new_query_database(database)
+        # Stops the engine once the response is abandoned
+        cancelled = threading.Event()
+        timer = lglass.whois.engine.StageTimer()
+        explanation = None
+        if query_args.explain:
+            explanation = lglass.whois.explain.Explanation()
+            database = lglass.proxy.TimingProxyDatabase(database,
+                                                        explanation.record)
         try:
             for term in terms:
                 # Replace underscore by spaces
@@ -250,45 +1004,308 @@ class SimpleWhoisServer(Base):
                 # execute until we issue the first next() call on the
                 # generator.
                 results = self.engine.query_lazy(term, database=database,
-                                                 **query_kwargs)
-                # To execute the blocking call to next() on the results
-                # generator, we use AsyncIteratorWrapper to execute it in an
-                # executor, turning the iterator into an asynchronous iterator.
-                results = AsyncIteratorWrapper(results, executor=self.executor)
-                # We further defer the formatting and iteration into another
-                # method.
-                return await self.send_results(
+                                                 cancelled=cancelled,
+                                                 timer=timer, **query_kwargs)
+                profile = None
+                if self.profiler is not None:
+                    profile = self.profiler.sample(term)
+                # The generator is consumed and formatted in the executor by
+                # send_results.
+                sending = self.send_results(
                     writer,
                     results,
                     primary_keys=query_args.primary_keys,
                     pretty_print_options={
                         "min_padding": 16,
                         "add_padding": 0},
-                    database=database)
+                    database=database,
+                    executor=lane.executor if lane is not None else None,
+                    cancelled=cancelled, timer=timer, profile=profile)
+                if explanation is not None:
+                    n = await self.explain_query(sending, explanation, timer,
+                                                 database_name, writer)
+                else:
+                    n = await sending
+                self._objects_metric.inc(n)
+                for stage, seconds in timer.seconds.items():
+                    self._engine_stage_metric.observe(seconds, stage=stage)
+                return n
         finally:
             if hasattr(database, "close"):
                 database.close()
 
+    async def explain_query(self, sending, explanation, timer, source,
+                            writer):
+        """ Awaits the coroutine 'sending' within the scope of the
+        explanation and its own I/O counters, which are added to the counters
+        of the query afterwards, and writes the explanation. """
+        outer = lglass.iostats.current()
+        with lglass.iostats.scope() as counters, \
+                lglass.whois.explain.scope(explanation):
+            try:
+                n = await sending
+            finally:
+                if outer is not None:
+                    outer.update(counters)
+        lines = ["Explanation for source {}".format(source)]
+        lines.extend(explanation.format(timer=timer, counters=counters))
+        writer.write(self.format_comment("\n".join(lines)).encode() + b"\n")
+        return n
+
+    async def query_source(self, database, terms, query_args, query_kwargs,
+                           writer):
+        """ Like perform_query, but gives up after 'source_timeout' seconds
+        and writes a notice to the writer instead. """
+        try:
+            return await asyncio.wait_for(
+                self.perform_query(database, terms, query_args, query_kwargs,
+                                   writer),
+                self.source_timeout)
+        except asyncio.TimeoutError:
+            writer.write(self.source_timeout_template.format(
+                source=database.database_name).encode())
+            # Partial responses are not cached
+            stop_recording = getattr(writer, "stop_recording", None)
+            if stop_recording is not None:
+                stop_recording()
+            return 0
+
+    async def perform_queries(self, databases, terms, query_args,
+                              query_kwargs, writer):
+        """ Queries all databases concurrently and writes the responses in
+        the order of the databases. The response of the first database is
+        streamed, the others are buffered until they are due. Unless this is
+        an inverse query, the remaining queries are cancelled once a database
+        returned results. The buffers are limited to 'response_buffer_size'
+        bytes. Returns True if any results were found. """
+        buffers = [writer] + [BufferWriter(writer, self.response_buffer_size)
+                              for _ in databases[1:]]
+        tasks = [asyncio.ensure_future(
+                 self.query_source(database, terms, query_args, query_kwargs,
+                                   buffer))
+                 for database, buffer in zip(databases, buffers)]
+        found_any = False
+        try:
+            for task, buffer in zip(tasks, buffers):
+                if buffer is not writer:
+                    buffer.release()
+                results = await task
+                await writer.drain()
+                if results:
+                    found_any = True
+                    if not query_args.inverse:
+                        break
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        return found_any
+
+    def source_status(self, database):
+        """Return the source line for a database, as used by '-q sources',
+        which consists of name, NRTM version, mirroring flag and the range
+        of available serials."""
+        journal = getattr(database, "journal", None)
+        if journal is None or not self.allow_mirroring:
+            return "{}:3:N:0-0".format(database.database_name)
+        return "{}:3:Y:{}-{}".format(database.database_name,
+                                     journal.first_serial, journal.last_serial)
+
+    async def mirror(self, request, writer, keepalive=False):
+        """ Streams the changes of a database within a range of serials in
+        NRTMv3 format. The request has the form SOURCE:3:FIRST-LAST, where
+        LAST may be 'LAST'. If 'keepalive' is set, the connection is kept open
+        and new changes are pushed as they appear in the journal. """
+        loop = asyncio.get_running_loop()
+        try:
+            source, version, serials = request.split(":")
+            first, last = serials.split("-")
+            first = int(first)
+            last = None if last.upper() == "LAST" else int(last)
+        except ValueError:
+            writer.write(self.mirror_syntax_template.encode())
+            return
+        if version != "3":
+            writer.write(self.mirror_version_template.encode())
+            return
+        database = None
+        for db in self.databases:
+            if db.database_name.upper() == source.upper() and \
+                    getattr(db, "journal", None) is not None:
+                database = db
+                break
+        if database is None or not self.allow_mirroring:
+            writer.write(self.mirror_source_template.format(
+                source=source).encode())
+            return
+
+        journal = database.journal
+        await loop.run_in_executor(self.executor, journal.refresh)
+        first_serial = await loop.run_in_executor(
+            self.executor, lambda: journal.first_serial)
+        if last is None:
+            last = journal.last_serial
+        if first < first_serial or last > journal.last_serial or \
+                first > last + 1:
+            writer.write(self.mirror_range_template.format(
+                first=first_serial, last=journal.last_serial).encode())
+            return
+        if first <= last:
+            await self.send_changes(writer, database, first, last)
+        while keepalive and not writer.is_closing():
+            await asyncio.sleep(self.mirror_poll_interval)
+            await loop.run_in_executor(self.executor, journal.refresh)
+            if journal.last_serial > last:
+                first, last = last + 1, journal.last_serial
+                await self.send_changes(writer, database, first, last)
+
+    async def send_changes(self, writer, database, first, last,
+                           chunk_size=100):
+        """ Writes the changes of a database from serial 'first' to 'last' in
+        NRTMv3 format. The journal is read and formatted in chunks in the
+        executor. """
+        loop = asyncio.get_running_loop()
+        source = database.database_name
+        changes = itertools.takewhile(lambda c: c[0] <= last,
+                                      database.changes(first - 1))
+
+        def _render_chunk():
+            chunk = []
+            for serial, operation, obj in itertools.islice(changes,
+                                                           chunk_size):
+                if obj.source is None:
+                    obj.source = source
+                chunk.append("{} {}\n\n".format(operation, serial))
+                chunk.append("".join(obj.pretty_print(min_padding=16,
+                                                      add_padding=0)))
+                chunk.append("\n")
+            return "".join(chunk).encode()
+
+        writer.write("%START Version: 3 {} {}-{}\n\n".format(
+            source, first, last).encode())
+        while True:
+            chunk = await loop.run_in_executor(self.executor, _render_chunk)
+            if not chunk:
+                break
+            writer.write(chunk)
+            await writer.drain()
+        writer.write("%END {}\n\n".format(source).encode())
+        await writer.drain()
+
     async def handle_persistent(self, reader, writer):
+        if self.pipeline_depth > 1:
+            return await self.handle_pipelined(reader, writer)
         while True:
             if self.preamble is not None:
                 writer.write(self.preamble.encode())
-            request = await reader.readline()
-            request = request.decode()
+            request = await self.read_request(reader, writer)
+            if request is None:
+                break
             k = await self.query(request, writer)
             if k:
                 break
 
+    async def handle_pipelined(self, reader, writer):
+        """ Reads ahead up to 'pipeline_depth' requests of a persistent
+        connection and runs their queries concurrently. The responses are
+        written in the order of the requests. The response which is due is
+        streamed, the others are buffered up to 'response_buffer_size' bytes
+        each, after which their queries are paused. """
+        queue = asyncio.Queue()
+        slots = asyncio.Semaphore(self.pipeline_depth)
+
+        async def _read():
+            try:
+                while True:
+                    await slots.acquire()
+                    buffer = BufferWriter(writer, self.response_buffer_size)
+                    request = await self.read_request(reader, buffer)
+                    if request is None:
+                        # Pass on the error message, if any
+                        queue.put_nowait((None, buffer))
+                        break
+                    task = asyncio.ensure_future(self.query(request, buffer))
+                    queue.put_nowait((task, buffer))
+            finally:
+                queue.put_nowait(None)
+
+        reading = asyncio.ensure_future(_read())
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                task, buffer = item
+                if task is None:
+                    buffer.release()
+                    break
+                if self.preamble is not None:
+                    writer.write(self.preamble.encode())
+                buffer.release()
+                k = await task
+                await writer.drain()
+                slots.release()
+                if k:
+                    break
+        finally:
+            reading.cancel()
+            await asyncio.gather(reading, return_exceptions=True)
+            # Discard the responses to requests after the last one
+            while not queue.empty():
+                item = queue.get_nowait()
+                if item is not None and item[0] is not None:
+                    item[0].cancel()
+                    await asyncio.gather(item[0], return_exceptions=True)
+
+    async def read_request(self, reader, writer):
+        """ Reads a request line. Returns None at the end of the input, or
+        when the client stays idle for 'idle_timeout' seconds or sends a
+        line longer than 'max_request_length' bytes, in which case an error
+        message is written. """
+        try:
+            request = await asyncio.wait_for(reader.readline(),
+                                             self.idle_timeout)
+        except asyncio.TimeoutError:
+            writer.write(self.idle_timeout_template.encode())
+            return None
+        except ValueError:
+            # The line exceeds the limit of the stream reader
+            writer.write(self.line_too_long_template.encode())
+            return None
+        if not request:
+            return None
+        if self.max_request_length is not None and \
+                len(request) > self.max_request_length:
+            writer.write(self.line_too_long_template.encode())
+            return None
+        return request.decode(errors="replace")
+
     async def handle(self, reader, writer):
-        if self.preamble is not None:
-            writer.write(self.preamble.encode())
-        request = await reader.readline()
-        request = request.decode()
-        persistent_connection = await self.query(request, writer)
-        if persistent_connection:
-            await self.handle_persistent(reader, writer)
-        await writer.drain()
-        writer.close()
+        if self.max_connections is not None and \
+                self.connections >= self.max_connections:
+            writer.write(self.connection_limit_template.encode())
+            writer.close()
+            return
+        self.connections += 1
+        try:
+            if self.write_buffer_high is not None:
+                writer.transport.set_write_buffer_limits(
+                    self.write_buffer_high, self.write_buffer_low)
+            if self.write_timeout is not None:
+                writer = DrainTimeoutWriter(writer, self.write_timeout)
+            if self.preamble is not None:
+                writer.write(self.preamble.encode())
+            request = await self.read_request(reader, writer)
+            if request is not None:
+                persistent_connection = await self.query(request, writer)
+                if persistent_connection:
+                    await self.handle_persistent(reader, writer)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
 
     def format_comment(self, comment):
         res = ""
@@ -306,10 +1323,69 @@ def main(args=None, database_cls=lglass.nic.FileDatabase,
     argparser.add_argument("--preamble", "-P")
     argparser.add_argument("--sources")
     argparser.add_argument("--handle-hint")
+    argparser.add_argument("--abuse-index", action="store_true",
+                           help="precompute the abuse contacts of the "
+                           "databases")
+    argparser.add_argument("--abuse-inherit", action="store_true",
+                           help="inherit abuse contacts from less specific "
+                           "inetnums (implies --abuse-index)")
+    argparser.add_argument("--prefix-index", action="store_true",
+                           help="keep an index of the networks of the "
+                           "databases for more specific queries")
+    argparser.add_argument("--more-specific-limit", type=int,
+                           help="return at most N more specific objects")
+    argparser.add_argument("--workers", "-w", type=int,
+                           help="number of worker processes")
+    argparser.add_argument("--cache-ttl", type=float,
+                           help="cache responses for SECONDS")
+    argparser.add_argument("--concurrent-sources", action="store_true",
+                           help="query multiple sources concurrently")
+    argparser.add_argument("--source-timeout", type=float,
+                           help="give up on a source after SECONDS")
+    argparser.add_argument("--query-deadline", type=float,
+                           help="abandon queries after SECONDS")
+    argparser.add_argument("--idle-timeout", type=float,
+                           help="close idle connections after SECONDS")
+    argparser.add_argument("--write-timeout", type=float,
+                           help="close connections which don't read their "
+                           "responses within SECONDS")
+    argparser.add_argument("--max-connections", type=int,
+                           help="maximum number of open connections")
+    argparser.add_argument("--write-buffer-high", type=int,
+                           help="high watermark of write buffers in bytes")
+    argparser.add_argument("--write-buffer-low", type=int,
+                           help="low watermark of write buffers in bytes")
+    argparser.add_argument("--pipeline", type=int, default=1,
+                           help="number of requests to read ahead on "
+                           "persistent connections")
+    argparser.add_argument("--rate-limit", type=float,
+                           help="tokens per second and client network")
+    argparser.add_argument("--burst", type=float, default=50,
+                           help="maximum number of tokens of a client network")
+    argparser.add_argument("--max-queries", type=int,
+                           help="maximum number of concurrent queries")
+    argparser.add_argument("--light-threads", type=int,
+                           help="threads for point lookups")
+    argparser.add_argument("--heavy-threads", type=int,
+                           help="threads for inverse, more specific and "
+                           "multi-source queries")
+    argparser.add_argument("--max-queued", type=int,
+                           help="maximum number of waiting queries per lane")
+    argparser.add_argument("--profile", metavar="DIRECTORY",
+                           help="write profiles of sampled queries")
+    argparser.add_argument("--profile-format", default="cprofile",
+                           choices=["cprofile", "stacks"])
+    argparser.add_argument("--profile-every", type=int, default=100,
+                           help="profile every N-th query")
+    argparser.add_argument("--debug", action="store_true",
+                           help="append timing and I/O counters to "
+                           "responses")
+    argparser.add_argument("--metrics-address", default="127.0.0.1")
+    argparser.add_argument("--metrics-port", type=int,
+                           help="serve Prometheus metrics on PORT")
     argparser.add_argument("databases", nargs="+")
 
     if args is None:
-        import sys
         args = sys.argv[1:]
 
     args = argparser.parse_args(args=args)
@@ -319,7 +1395,36 @@ def main(args=None, database_cls=lglass.nic.FileDatabase,
         databases.append(database_cls(db))
 
     engine = engine_cls()
-    server = server_cls(engine, databases)
+    response_cache = None
+    if args.cache_ttl:
+        response_cache = ResponseCache(ttl=args.cache_ttl)
+    admission_control = None
+    if args.rate_limit or args.max_queries:
+        admission_control = AdmissionControl(
+            rate=args.rate_limit, burst=args.burst,
+            max_concurrent=args.max_queries)
+    lanes = {}
+    if args.light_threads:
+        lanes["light"] = ExecutorLane(args.light_threads, args.max_queued)
+    if args.heavy_threads:
+        lanes["heavy"] = ExecutorLane(args.heavy_threads, args.max_queued)
+    server = server_cls(engine, databases, response_cache=response_cache,
+                        admission_control=admission_control, lanes=lanes)
+
+    server.concurrent_sources = args.concurrent_sources
+    server.source_timeout = args.source_timeout
+    server.pipeline_depth = args.pipeline
+    server.query_deadline = args.query_deadline
+    server.idle_timeout = args.idle_timeout
+    server.write_timeout = args.write_timeout
+    server.max_connections = args.max_connections
+    server.write_buffer_high = args.write_buffer_high
+    server.write_buffer_low = args.write_buffer_low
+    server.debug = args.debug
+    if args.profile is not None:
+        server.profiler = lglass.whois.profiling.QueryProfiler(
+            args.profile, format=args.profile_format,
+            sample_every=args.profile_every)
 
     if args.preamble is not None:
         with open(args.preamble) as fh:
@@ -328,20 +1433,63 @@ def main(args=None, database_cls=lglass.nic.FileDatabase,
     if args.handle_hint is not None:
         engine.type_hints[args.handle_hint] = engine.handle_classes
 
+    if args.abuse_index or args.abuse_inherit:
+        for database in databases:
+            index = lglass.whois.abuse.AbuseContactIndex(
+                database, inherit=args.abuse_inherit)
+            index.build()
+            engine.abuse_indexes[database.database_name] = index
+
+    if args.prefix_index:
+        for database in databases:
+            index = lglass.whois.indexes.PrefixIndex(
+                database,
+                classes=engine.filter_classes(
+                    engine.cidr_classes | engine.address_classes,
+                    database=database))
+            index.build()
+            engine.prefix_indexes[database.database_name] = index
+    engine.more_specific_limit = args.more_specific_limit
+
     if args.sources is not None:
         server.sources = args.sources.split(",")
 
-    run_server(server, args.address.split(","), args.port)
+    if args.workers:
+        run_workers(server, args.address.split(","), args.port, args.workers,
+                    metrics_address=args.metrics_address,
+                    metrics_port=args.metrics_port)
+    else:
+        run_server(server, args.address.split(","), args.port,
+                   metrics_address=args.metrics_address,
+                   metrics_port=args.metrics_port)
 
 
-def run_server(server, addresses, port):
-    loop = asyncio.get_event_loop()
+def run_server(server, addresses, port, reuse_port=None,
+               shutdown_timeout=30, metrics_address=None, metrics_port=None):
+    """ Runs the server in a new event loop until SIGTERM or SIGINT is
+    received. Then the listening sockets are closed and open connections get
+    'shutdown_timeout' seconds to finish before they are cancelled. If
+    'metrics_port' is given, the metrics of the server are served over HTTP
+    on that port. """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    kwargs = {}
+    if getattr(server, "max_request_length", None) is not None:
+        # Bound the buffer of the stream reader to the request length
+        kwargs["limit"] = server.max_request_length
     coro = asyncio.start_server(
         server.handle,
         addresses,
         port,
-        loop=loop)
+        reuse_port=reuse_port,
+        **kwargs)
     s = loop.run_until_complete(coro)
+    metrics_server = None
+    if metrics_port is not None:
+        metrics_server = loop.run_until_complete(
+            lglass.whois.metrics.start_http_server(
+                server.metrics, metrics_address, metrics_port))
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
 
     try:
         loop.run_forever()
@@ -349,9 +1497,86 @@ def run_server(server, addresses, port):
         pass
 
     s.close()
+    if metrics_server is not None:
+        metrics_server.close()
+    # Drain open connections. This precedes wait_closed, which waits for all
+    # connections to be closed since Python 3.12.1.
+    pending = asyncio.all_tasks(loop)
+    if pending:
+        _, pending = loop.run_until_complete(
+            asyncio.wait(pending, timeout=shutdown_timeout))
+        for task in pending:
+            task.cancel()
+        loop.run_until_complete(
+            asyncio.gather(*pending, return_exceptions=True))
     loop.run_until_complete(s.wait_closed())
+    if metrics_server is not None:
+        loop.run_until_complete(metrics_server.wait_closed())
     loop.close()
 
 
+def run_workers(server, addresses, port, workers, shutdown_timeout=30,
+                metrics_address=None, metrics_port=None):
+    """ Forks 'workers' processes, which bind to the same addresses using
+    SO_REUSEPORT and run their own event loop, and supervises them. Workers
+    which exit unexpectedly are restarted. On SIGTERM or SIGINT, the workers
+    are asked to drain their connections and the supervisor waits for them
+    to exit. The server must not have started an executor before, since
+    threads don't survive fork(). Every worker serves its metrics on its
+    own port, counting up from 'metrics_port'. """
+    children = {}
+    stopping = False
+
+    def _spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                run_server(server, addresses, port, reuse_port=True,
+                           shutdown_timeout=shutdown_timeout,
+                           metrics_address=metrics_address,
+                           metrics_port=metrics_port + index
+                           if metrics_port is not None else None)
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+            finally:
+                os._exit(status)
+        children[pid] = (time.monotonic(), index)
+
+    def _stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+    for index in range(workers):
+        _spawn(index)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        child = children.pop(pid, None)
+        if child is None or stopping:
+            continue
+        started, index = child
+        print("Worker {} exited with status {}, restarting".format(
+            pid, status), file=sys.stderr)
+        # Avoid busy restarts of workers which crash on start
+        if time.monotonic() - started < 1:
+            time.sleep(1)
+        if not stopping:
+            _spawn(index)
+
+
 if __name__ == "__main__":
     main()